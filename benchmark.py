@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+#coding:utf-8
+
+from pathlib import Path
+import sys
+import os
+import io
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+from repository_path import KanjiPath
+from toml_cache import TomlCache
+from logging import getLogger, basicConfig, WARNING, INFO
+logger = getLogger(__name__)
+
+# 合成したマスターデータで各ツールの処理時間とメモリを計測する
+# path.toml の root は使わず、一時ディレクトリにデータを作ってそこを root として読み込む
+
+PATH_TOML = '''[tool.path]
+  root = "%s"
+  [tool.path.relative]
+    md        = "schema/master/"
+    md_toml   = "schema/master/masterdata.toml"
+    md_class  = "schema/master/class/"
+    md_header = "schema/master_header/"
+    md_binary = "schema/master_binary/"
+'''
+FIELD_TYPES = ('int', 'float', 'double', 'string', 'Vec2')
+
+
+# masterdata.toml / id.toml / class/**/*.toml を合成する
+# 型は depth 段のディレクトリに振り分け、各型は主キーIDと、他の型のIDを参照するfieldを1つ持つ
+class SyntheticMasterData:
+    def __init__(self, types:int, fields:int, records:int, depth:int, seed:int=0):
+        self.types = types
+        self.fields = fields
+        self.records = records
+        self.depth = depth
+        self.random = random.Random(seed)
+
+    def type_name(self, index:int) -> str:
+        return 'Bench%d' % index
+
+    # e.g. depth=2 -> ('g0_1', 'g1_2')。depth=0 なら class 直下
+    def group(self, index:int) -> tuple:
+        return tuple('g%d_%d' % (level, index % (level + 2)) for level in range(self.depth))
+
+    def id_begin(self, index:int) -> int:
+        return index * self.records * 2
+
+    def field_types(self, index:int) -> list:
+        field_types = [('id', '%s:ID:PKey' % self.type_name(index)), ('ref', '%s:ID' % self.type_name((index + 1) % self.types))]
+        for field_index in range(max(self.fields - 2, 0)):
+            field_types.append(('f%d' % field_index, FIELD_TYPES[field_index % len(FIELD_TYPES)]))
+        return field_types
+
+    def write(self, root:Path):
+        md = root / 'schema' / 'master'
+        os.makedirs(md / 'class', exist_ok=True)
+        with open(root / 'path.toml', 'w') as f:
+            f.write(PATH_TOML % root.as_posix())
+        with open(md / 'id.toml', 'w') as f:
+            for index in range(self.types):
+                f.write('[id.%s]\nname = "%s"\nbegin = %d\nend = %d\n' % (
+                    self.type_name(index).lower(), self.type_name(index), self.id_begin(index), self.id_begin(index) + self.records * 2 - 1))
+        with open(md / 'masterdata.toml', 'w') as f:
+            for index in range(self.types):
+                table = '.'.join(('masterdata',) + self.group(index) + ('md_bench%d' % index,))
+                f.write('[%s]\ndata_type_name = "%s"\n[%s.field]\n' % (table, self.type_name(index), table))
+                for name, type_attribute in self.field_types(index):
+                    f.write('%s = "%s"\n' % (name, type_attribute))
+        for index in range(self.types):
+            directory = md / 'class' / Path(*self.group(index))
+            os.makedirs(directory, exist_ok=True)
+            with open(directory / ('%s.toml' % self.type_name(index)), 'w') as f:
+                f.write(self.class_toml(index))
+
+    def class_toml(self, index:int) -> str:
+        lines = list()
+        ref_begin = self.id_begin((index + 1) % self.types)
+        for record in range(self.records):
+            lines.append('[masterdata.r%d]' % record)
+            for name, type_attribute in self.field_types(index):
+                lines.append('%s = %s' % (name, self.value(type_attribute, self.id_begin(index) + record, ref_begin)))
+        return '\n'.join(lines) + '\n'
+
+    def value(self, type_attribute:str, id:int, ref_begin:int) -> str:
+        if type_attribute.endswith(':PKey'):
+            return str(id)
+        if type_attribute.endswith(':ID'):
+            return str(ref_begin + self.random.randrange(self.records))
+        if type_attribute == 'int':
+            return str(self.random.randrange(1000))
+        if type_attribute in ('float', 'double'):
+            return repr(self.random.random())
+        if type_attribute == 'string':
+            return '"text%d"' % self.random.randrange(100)
+        return '[%r, %r]' % (self.random.random(), self.random.random())
+
+
+# 1つの処理の時間とメモリを計測する
+# 時間は tracemalloc を切った状態で、メモリのピークは別にもう一度実行して測る
+def measure(function, count:int, unit:str, memory:bool=True) -> dict:
+    with contextlib.redirect_stdout(io.StringIO()):
+        begin = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - begin
+        peak_bytes = None
+        if memory:
+            tracemalloc.start()
+            function()
+            _, peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    return {
+        'seconds': seconds,
+        'count': count,
+        'unit': unit,
+        'throughput': count / seconds if seconds > 0 else None,
+        'peak_bytes': peak_bytes}
+
+def run_benchmark(root:Path, data:SyntheticMasterData, jobs:int, lookups:int, memory:bool) -> dict:
+    KanjiPath.load(root / 'path.toml')
+    from id_manage import IdManager
+    IdManager.ID_TOML = str(root / 'schema' / 'master' / 'id.toml')
+    from master_type import MDTypeManager
+    from validate_data import MDValidator
+    import build_schema
+
+    record_count = data.types * data.records
+    phases = dict()
+    phases['MDTypeManager'] = measure(MDTypeManager, data.types, 'types', memory)
+    mgr = MDTypeManager()
+    dest_dir = KanjiPath.absolute('md_header')
+    phases['create_cpp_sources'] = measure(
+        lambda: build_schema.create_cpp_sources(mgr, dest_dir, jobs, clean=True), data.types, 'types', memory)
+    validator = MDValidator()
+    phases['MDValidator.validate'] = measure(lambda: validator.validate(jobs), record_count, 'records', memory)
+    id_mgr = IdManager()
+    end = data.id_begin(data.types)
+    ids = [data.random.randrange(end) for _ in range(lookups)]
+    phases['IdManager.search_id_by_int'] = measure(lambda: [id_mgr.search_id_by_int(id) for id in ids], lookups, 'lookups', memory)
+    phases['IdManager.search_ids_by_int'] = measure(lambda: id_mgr.search_ids_by_int(ids), lookups, 'lookups', memory)
+    return phases
+
+# baseline より threshold (割合) 以上遅くなった処理を返す
+def find_regressions(result:dict, baseline:dict, threshold:float) -> list:
+    regressions = list()
+    for name, phase in result['phases'].items():
+        if not name in baseline['phases']:
+            continue
+        base_seconds = baseline['phases'][name]['seconds']
+        if phase['seconds'] > base_seconds * (1 + threshold):
+            regressions.append((name, base_seconds, phase['seconds']))
+    return regressions
+
+def summary(result:dict) -> str:
+    lines = list()
+    for name, phase in result['phases'].items():
+        peak = '-' if phase['peak_bytes'] == None else '%.1f MiB' % (phase['peak_bytes'] / 1024 / 1024)
+        lines.append('%-32s %9.3f s %12.0f %s/s  peak %s' % (name, phase['seconds'], phase['throughput'] or 0, phase['unit'], peak))
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    basicConfig(level=WARNING)
+    parser = argparse.ArgumentParser(description='合成したマスターデータで各ツールの性能を測る')
+    parser.add_argument('--types', type=int, default=50)
+    parser.add_argument('--fields', type=int, default=8)
+    parser.add_argument('--records', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=1,
+        help='class 以下のディレクトリの深さ')
+    parser.add_argument('--lookups', type=int, default=100000,
+        help='IdManager で引く数値の数')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true',
+        help='メモリのピークを測らない (各処理を1回しか実行しない)')
+    parser.add_argument('--cache', action='store_true',
+        help='パース済みtomlのキャッシュを使う (既定では使わない)')
+    parser.add_argument('--output', type=Path,
+        help='結果をJSONで書き出すパス')
+    parser.add_argument('--baseline', type=Path,
+        help='比較するJSON。threshold以上遅くなった処理があれば終了コード1')
+    parser.add_argument('--threshold', type=float, default=0.2,
+        help='遅くなったとみなす割合 (0.2 = 20%%)')
+    args = parser.parse_args()
+    TomlCache.set_enabled(args.cache)
+
+    data = SyntheticMasterData(args.types, args.fields, args.records, args.depth, args.seed)
+    with tempfile.TemporaryDirectory(prefix='kanji-benchmark-') as temp_dir:
+        root = Path(temp_dir)
+        data.write(root)
+        jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+        phases = run_benchmark(root, data, jobs, args.lookups, not args.no_memory)
+    result = {
+        'config': {key: value for key, value in vars(args).items() if key in ('types', 'fields', 'records', 'depth', 'lookups', 'jobs', 'seed', 'cache')},
+        'phases': phases}
+    print(summary(result))
+    if args.output != None:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline != None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(result, baseline, args.threshold)
+        for name, base_seconds, seconds in regressions:
+            print('REGRESSION %s: %.3f s -> %.3f s (+%.0f%%)' % (name, base_seconds, seconds, (seconds / base_seconds - 1) * 100))
+        sys.exit(1 if len(regressions) != 0 else 0)
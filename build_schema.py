@@ -5,66 +5,414 @@ from pathlib import Path
 import sys
 import os
 import shutil
+import difflib
+import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor
 import toml
 from repository_path import KanjiPath
-from cpp_source_generator import DataHppGenerator, RepositoryHppGenerator, RepositoryCppGenerator
+from toml_cache import TomlCache
+from profiler import Profiler, add_profile_argument
+from cpp_source_generator import DataHppGenerator, RepositoryHppGenerator, RepositoryCppGenerator, RepositoryBinaryCppGenerator, MasterDataLoaderHppGenerator, MasterDataLoaderCppGenerator, MasterStringPoolHppGenerator, MasterStringPoolCppGenerator, GENERATOR_VERSION
 from master_type import MDTypeInfo, MDTypeManager
+from id_manage import IdManager
 from logging import getLogger, basicConfig, DEBUG, INFO
 logger = getLogger(__name__)
 
 IS_DEBUG = False
+# 書き込まずに、出力先との差分の一覧だけを表示する
+IS_DRY_RUN = False
 
-# file_path に text を書き込むだけ
-def output(file_path:Path, text:str):
-    os.makedirs(file_path.parent.absolute(), exist_ok=True)
-    logger.info('create file: %s' % file_path.relative_to(KanjiPath.absolute('md_header')))
-    with open(file_path,'w') as f:
-        f.write(text)
-
-# hpp/cpp内容を生成して書き込む
-# IS_DEBUG 時は書き込まずにprintする
-def create_cpp_source(generator, type_info:MDTypeInfo, file_path:Path):
-    full_text = generator.generate(type_info)
+# 生成方法の指定。manifestにも記録し、変わったら差分ビルドでも生成し直す
+# repository: 'toml' なら TomlAsset から、'binary' なら md_binary.py が書き出した .mdb から読み込む
+# layout: 'map' なら主キーの連想配列、'dense' なら ID - begin を添字にした配列、'columns' なら field ごとの配列
+# id_begins: dense 時に使う IDの名前 -> id.toml の begin
+# compact: Master のメンバを詰めて並べ、string を MasterStringPool の添字で持つ
+DEFAULT_OPTIONS = {'repository': 'toml', 'layout': 'map', 'id_begins': {}, 'compact': False}
+
+# 差分ビルド用に、前回生成時の型ごとのハッシュと生成ファイルを記録しておくファイル
+MANIFEST_NAME = '.manifest.toml'
+
+# 生成した内容をメモリ上にまとめておき、出力先へまとめて反映する
+# 書き込みの途中で失敗しても出力先は前の状態のまま残り、C++ のビルドが書きかけのファイルを見ることがない
+#   commit_tree: 出力先ごと入れ替える (全生成)。隣の一時ディレクトリにすべて書いてから rename で差し替える
+#   commit: 差分のファイルだけを一時ファイルに書き、すべて書けてから rename で置き換える
+# 内容が同じファイルは書き込まない (mtimeを変えずC++側の再ビルドを避ける)
+class StagedOutput:
+    def __init__(self, path_dst:Path, outputs:list):
+        self.path_dst = path_dst
+        # path_dst からの相対パス -> 内容
+        self.files = {file_path.relative_to(path_dst): text for file_path, text in outputs}
+
+    def existing_files(self) -> set:
+        if not self.path_dst.is_dir():
+            return set()
+        return {file_path.relative_to(self.path_dst) for file_path in self.path_dst.glob('**/*') if file_path.is_file()}
+
+    def read(self, relative_path:Path) -> str:
+        with open(self.path_dst / relative_path) as f:
+            return f.read()
+
+    # valid_files: 生成しなかったが残すファイル。None なら出力先ごと入れ替える (staged にないファイルはすべて消える)
+    # {'added': [..], 'modified': [..], 'unchanged': [..], 'removed': [..]} を返す
+    def diff(self, valid_files:set=None) -> dict:
+        existing = self.existing_files()
+        result = {'added': [], 'modified': [], 'unchanged': [], 'removed': []}
+        for relative_path, text in sorted(self.files.items()):
+            if not relative_path in existing:
+                result['added'].append(relative_path)
+            elif self.read(relative_path) == text:
+                result['unchanged'].append(relative_path)
+            else:
+                result['modified'].append(relative_path)
+        kept = set(self.files) | (set(valid_files) if valid_files != None else set())
+        result['removed'] = sorted(existing - kept)
+        return result
+
+    # --dry-run で表示する差分の一覧。変更のあるファイルは増減した行数も出す
+    def summary(self, diff:dict) -> str:
+        lines = ['A %s' % relative_path.as_posix() for relative_path in diff['added']]
+        for relative_path in diff['modified']:
+            added = removed = 0
+            for line in difflib.unified_diff(self.read(relative_path).splitlines(), self.files[relative_path].splitlines(), lineterm='', n=0):
+                if line.startswith('+') and not line.startswith('+++'):
+                    added += 1
+                elif line.startswith('-') and not line.startswith('---'):
+                    removed += 1
+            lines.append('M %s (+%d -%d)' % (relative_path.as_posix(), added, removed))
+        lines.extend('D %s' % relative_path.as_posix() for relative_path in diff['removed'])
+        lines.append('%d added, %d modified, %d removed, %d unchanged' % tuple(len(diff[state]) for state in ('added', 'modified', 'removed', 'unchanged')))
+        return '\n'.join(lines)
+
+    # IS_DEBUG 時は書き込まずにprintする
+    def print_all(self):
+        for relative_path, text in self.files.items():
+            print('// %s ------------------------------------------' % relative_path.name)
+            print(text)
+
+    def write_files(self, root:Path, relative_paths, suffix:str=''):
+        directories = {(root / relative_path).parent for relative_path in relative_paths}
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
+        for relative_path in relative_paths:
+            text = self.files[relative_path]
+            logger.info('create file: %s' % relative_path)
+            with open(root / (str(relative_path) + suffix), 'w') as f:
+                f.write(text)
+            Profiler.count('files_written')
+            Profiler.count('bytes_written', len(text.encode('utf-8')))
+
+    def commit_tree(self):
+        with Profiler.span('commit_tree', 'io', files=len(self.files)):
+            self.commit_tree_impl()
+
+    def commit_tree_impl(self):
+        parent = self.path_dst.absolute().parent
+        staging = parent / ('.%s.staging' % self.path_dst.name)
+        backup = parent / ('.%s.old' % self.path_dst.name)
+        for leftover in (staging, backup):
+            if leftover.is_dir():
+                shutil.rmtree(leftover)
+        try:
+            self.write_files(staging, sorted(self.files))
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        if self.path_dst.is_dir():
+            os.rename(self.path_dst, backup)
+        try:
+            os.rename(staging, self.path_dst)
+        except BaseException:
+            if backup.is_dir():
+                os.rename(backup, self.path_dst)
+            raise
+        if backup.is_dir():
+            shutil.rmtree(backup)
+
+    def commit(self, diff:dict):
+        with Profiler.span('commit', 'io', files=len(diff['added']) + len(diff['modified'])):
+            self.commit_impl(diff)
+
+    # 一時ファイルは置き換えるファイルと同じディレクトリに作る (rename が同じファイルシステム内で済むように)
+    def commit_impl(self, diff:dict):
+        changed = diff['added'] + diff['modified']
+        suffix = '.%d.tmp' % os.getpid()
+        try:
+            self.write_files(self.path_dst, changed, suffix)
+        except BaseException:
+            for relative_path in changed:
+                Path(str(self.path_dst / relative_path) + suffix).unlink(missing_ok=True)
+            raise
+        for relative_path in changed:
+            os.replace(str(self.path_dst / relative_path) + suffix, self.path_dst / relative_path)
+        for relative_path in diff['removed']:
+            logger.info('remove orphan: %s' % relative_path)
+            (self.path_dst / relative_path).unlink()
+        remove_empty_directories(self.path_dst)
+
+# 生成したファイルがなくなって空になったディレクトリを消す
+def remove_empty_directories(path_dst:Path):
+    for directory in sorted(path_dst.glob('**/'), reverse=True):
+        if directory != path_dst and directory.is_dir() and not any(directory.iterdir()):
+            directory.rmdir()
+
+# 生成済みの内容を出力先に反映する
+# valid_files: 生成しなかったが残すファイル。None なら出力先ごと入れ替える
+def commit_outputs(path_dst:Path, outputs:list, valid_files:set=None):
+    staged = StagedOutput(path_dst, outputs)
     if IS_DEBUG:
-        print('// %s ------------------------------------------' % file_path.name)
-        print(full_text)
+        staged.print_all()
+    elif IS_DRY_RUN:
+        print(staged.summary(staged.diff(valid_files)))
+    elif valid_files == None:
+        staged.commit_tree()
     else:
-        output(file_path, full_text)
+        staged.commit(staged.diff(valid_files))
+
+# generator はファイルごとの状態を持たないので、同じ引数のものは型をまたいで使い回す
+@functools.lru_cache(maxsize=None)
+def cached_generator(generator_class, *args):
+    return generator_class(*args)
 
-# 1つの型についてhpp/cpp生成処理を呼び出す
-# MasterData自体のhpp、Repositoryのhpp/cppがあるので3ファイルを生成
-def create_cpp_sources_impl(type_info:MDTypeInfo, path:Path, key:str):
+# 1つの型について生成するファイルのパスと、それを生成するGeneratorの組
+# MasterData自体のhpp、Repositoryのhpp/cppがあるので3ファイル
+def cpp_source_targets(type_info:MDTypeInfo, path:Path, key:str, options:dict=DEFAULT_OPTIONS) -> list:
     indent = '    '
     if key == MDTypeManager.ROOT:
         key = ''
-    # MasterHoge.hpp
-    create_cpp_source(
-        DataHppGenerator(indent),
-        type_info,
-        path / 'class' / key / ('Master%s.hpp' % type_info.data_type_name))
-    # MasterHogeRepository.hpp
-    create_cpp_source(
-        RepositoryHppGenerator(indent),
-        type_info,
-        path / 'repository' / key / ('Master%sRepository.hpp' % type_info.data_type_name))
-    # MasterHogeRepository.cpp
-    create_cpp_source(
-        RepositoryCppGenerator(indent),
-        type_info,
-        path / 'repository' / key / ('Master%sRepository.cpp' % type_info.data_type_name))
-
-def create_cpp_sources(mgr:MDTypeManager, path_dst:Path):
-    for key in mgr.dict_info:
-        for value in mgr.dict_info[key].values():
-            create_cpp_sources_impl(value, path_dst, key)
+    dense_id_begin = find_dense_id_begin(type_info, options)
+    columns = uses_columns(type_info, options)
+    if options['repository'] == 'binary':
+        repository_cpp_generator = RepositoryBinaryCppGenerator(indent, (Path(key) / ('%s.mdb' % type_info.data_type_name)).as_posix(), dense_id_begin, columns)
+    else:
+        repository_cpp_generator = cached_generator(RepositoryCppGenerator, indent, dense_id_begin, columns)
+    return [
+        # MasterHoge.hpp
+        (cached_generator(DataHppGenerator, indent, options.get('compact', False)),
+         path / 'class' / key / ('Master%s.hpp' % type_info.data_type_name)),
+        # MasterHogeRepository.hpp
+        (cached_generator(RepositoryHppGenerator, indent, dense_id_begin, columns),
+         path / 'repository' / key / ('Master%sRepository.hpp' % type_info.data_type_name)),
+        # MasterHogeRepository.cpp
+        (repository_cpp_generator,
+         path / 'repository' / key / ('Master%sRepository.cpp' % type_info.data_type_name)),
+    ]
+
+# layout が dense のとき主キーIDの begin を返す
+# 主キーがIDでない、またはIDが id.toml に無い型は map のまま生成する
+def find_dense_id_begin(type_info:MDTypeInfo, options:dict) -> int:
+    if options['layout'] != 'dense':
+        return None
+    primary_key = type_info.fields[type_info.primary_key]
+    if not primary_key.is_id or not primary_key.type_name in options['id_begins']:
+        logger.warning('%s is generated as map layout because its primary key is not a ranged ID' % type_info.data_type_name)
+        return None
+    return options['id_begins'][primary_key.type_name]
+
+# layout が columns のとき field ごとの配列で生成するか
+# 主キーが int に直せない (ID・int でない) 型は map のまま生成する
+def uses_columns(type_info:MDTypeInfo, options:dict) -> bool:
+    if options['layout'] != 'columns':
+        return False
+    primary_key = type_info.fields[type_info.primary_key]
+    if not primary_key.is_id and primary_key.type_name != 'int':
+        logger.warning('%s is generated as map layout because its primary key is not an ID or int' % type_info.data_type_name)
+        return False
+    return True
+
+# 型ごとではない生成ファイル
+# 全型の Repository をまとめて読み込む MasterDataLoader の hpp/cpp
+# compact 時は全 Master 共通の MasterStringPool の hpp/cpp
+def shared_targets(path:Path, options:dict=DEFAULT_OPTIONS) -> list:
+    indent = '    '
+    targets = [
+        (cached_generator(MasterDataLoaderHppGenerator, indent), path / 'repository' / 'MasterDataLoader.hpp'),
+        (cached_generator(MasterDataLoaderCppGenerator, indent), path / 'repository' / 'MasterDataLoader.cpp'),
+    ]
+    if options.get('compact', False):
+        targets.append((cached_generator(MasterStringPoolHppGenerator, indent), path / 'class' / 'MasterStringPool.hpp'))
+        targets.append((cached_generator(MasterStringPoolCppGenerator, indent), path / 'class' / 'MasterStringPool.cpp'))
+    return targets
+
+# 型の増減・lazy の変更で変わるので、差分ビルドでも毎回生成する (内容が同じなら書き込まれない)
+def render_shared(mgr:MDTypeManager, path:Path, options:dict=DEFAULT_OPTIONS) -> list:
+    type_infos = [value for key in mgr.dict_info for value in mgr.dict_info[key].values()]
+    return [(file_path, generator.generate(type_infos)) for generator, file_path in shared_targets(path, options)]
+
+# 1つの型についてhpp/cpp内容を生成する (書き込みはしない)
+# (file_path, text) のリストを返す
+def render_cpp_sources(type_info:MDTypeInfo, path:Path, key:str, options:dict=DEFAULT_OPTIONS) -> list:
+    with Profiler.span('render_cpp_sources', 'generate', type=manifest_key(type_info, key), fields=len(type_info.fields)):
+        return [(file_path, generator.generate(type_info)) for generator, file_path in cpp_source_targets(type_info, path, key, options)]
+
+# ProcessPoolExecutor から呼べるようにモジュール直下に置く
+def render_cpp_sources_task(task:tuple) -> list:
+    return render_cpp_sources(*task)
+
+# tasks = [(type_info, path, key, options), ...] をjobs並列で生成する
+# 結果はtasksと同じ順に並べるので出力は並列数によらず同じになる
+# 失敗した型はまとめて errors に (型名, エラー内容) として返す
+def render_all(tasks:list, jobs:int) -> (list, list):
+    with Profiler.span('render_all', 'generate', types=len(tasks), jobs=jobs):
+        return render_all_impl(tasks, jobs)
+
+def render_all_impl(tasks:list, jobs:int) -> (list, list):
+    outputs = list()
+    errors = list()
+    if jobs == 1 or len(tasks) <= 1:
+        for task in tasks:
+            try:
+                outputs.extend(render_cpp_sources_task(task))
+            except Exception as e:
+                errors.append((manifest_key(task[0], task[2]), repr(e)))
+        return outputs, errors
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(render_cpp_sources_task, task) for task in tasks]
+        for task, future in zip(tasks, futures):
+            try:
+                outputs.extend(future.result())
+            except Exception as e:
+                errors.append((manifest_key(task[0], task[2]), repr(e)))
+    return outputs, errors
+
+def log_errors(errors:list):
+    for name, message in errors:
+        logger.error('failed to generate %s: %s' % (name, message))
+    logger.error('%d types failed to generate, no files were written' % len(errors))
+
+def generation_tasks(mgr:MDTypeManager, path_dst:Path, options:dict=DEFAULT_OPTIONS) -> list:
+    return [(value, path_dst, key, options) for key in mgr.dict_info for value in mgr.dict_info[key].values()]
+
+# 全型を生成してから書き込む。1つでも失敗したら何も書き込まずFalseを返す
+# clean 時は出力先を生成したファイルだけのディレクトリに入れ替える
+# 次の差分ビルドが全型を生成し直さないよう、manifest も一緒に書き出す
+def create_cpp_sources(mgr:MDTypeManager, path_dst:Path, jobs:int=1, clean:bool=False, options:dict=DEFAULT_OPTIONS) -> bool:
+    tasks = generation_tasks(mgr, path_dst, options)
+    outputs, errors = render_all(tasks, jobs)
+    if len(errors) != 0:
+        log_errors(errors)
+        return False
+    outputs.extend(render_shared(mgr, path_dst, options))
+    types = {manifest_key(value, key): manifest_entry(value, path, key, options) for value, path, key, _ in tasks}
+    outputs.append((path_dst / MANIFEST_NAME, render_manifest(types)))
+    commit_outputs(path_dst, outputs, None if clean else StagedOutput(path_dst, outputs).existing_files())
+    return True
+
+# manifest上で型を識別するキー e.g. 'kanji/KanjiParam'
+def manifest_key(type_info:MDTypeInfo, key:str) -> str:
+    if key == MDTypeManager.ROOT:
+        return type_info.data_type_name
+    return '%s/%s' % (key, type_info.data_type_name)
+
+def load_manifest(path_dst:Path) -> dict:
+    manifest_path = path_dst / MANIFEST_NAME
+    if not manifest_path.is_file():
+        return dict()
+    with open(manifest_path) as f:
+        manifest = toml.load(f)
+    if manifest.get('generator_version') != GENERATOR_VERSION:
+        logger.info('generator version changed, all types will be regenerated')
+        return dict()
+    return manifest.get('types', dict())
+
+# 1つの型の manifest の内容 (型定義のハッシュ、生成方法、生成するファイル)
+def manifest_entry(type_info:MDTypeInfo, path:Path, key:str, options:dict=DEFAULT_OPTIONS) -> dict:
+    return {
+        'hash': type_info.content_hash(),
+        'options': dict(options),
+        'files': [str(file_path.relative_to(path)) for _, file_path in cpp_source_targets(type_info, path, key, options)]}
+
+def render_manifest(types:dict) -> str:
+    return toml.dumps({'generator_version': GENERATOR_VERSION, 'types': types})
+
+def save_manifest(path_dst:Path, types:dict):
+    os.makedirs(path_dst, exist_ok=True)
+    temp_path = path_dst / (MANIFEST_NAME + '.tmp')
+    with open(temp_path, 'w') as f:
+        f.write(render_manifest(types))
+    os.replace(temp_path, path_dst / MANIFEST_NAME)
+
+# 型定義が変わった型だけを生成し直し、どの型からも生成されなくなったファイルを削除する
+def create_cpp_sources_incremental(mgr:MDTypeManager, path_dst:Path, jobs:int=1, options:dict=DEFAULT_OPTIONS) -> bool:
+    old_types = load_manifest(path_dst)
+    new_types = dict()
+    tasks = list()
+    for value, path, key, _ in generation_tasks(mgr, path_dst, options):
+        targets = cpp_source_targets(value, path, key, options)
+        entry = manifest_entry(value, path, key, options)
+        name = manifest_key(value, key)
+        new_types[name] = entry
+        up_to_date = old_types.get(name) == entry and all(file_path.is_file() for _, file_path in targets)
+        if up_to_date:
+            logger.debug('up to date: %s' % name)
+            continue
+        tasks.append((value, path, key, options))
+    outputs, errors = render_all(tasks, jobs)
+    if len(errors) != 0:
+        log_errors(errors)
+        return False
+    outputs.extend(render_shared(mgr, path_dst, options))
+    commit_outputs(path_dst, outputs, valid_files(path_dst, new_types, options))
+    if IS_DEBUG or IS_DRY_RUN:
+        return True
+    save_manifest(path_dst, new_types)
+    logger.info('%d/%d types regenerated' % (len(tasks), len(new_types)))
+    return True
+
+# 差分ビルドで出力先に残すファイル (path_dst からの相対パス)
+# これ以外のファイルは、どの型からも生成されなくなったものとして削除する
+def valid_files(path_dst:Path, types:dict, options:dict=DEFAULT_OPTIONS) -> set:
+    files = {Path(file) for entry in types.values() for file in entry['files']}
+    files.update(file_path.relative_to(path_dst) for _, file_path in shared_targets(path_dst, options))
+    files.add(Path(MANIFEST_NAME))
+    return files
+
+# 生成方法の指定を受け取る引数 (watch.py と共通)
+def add_option_arguments(parser:argparse.ArgumentParser):
+    parser.add_argument('--repository', choices=('toml', 'binary'), default=DEFAULT_OPTIONS['repository'],
+        help='Repositoryの読み込み元 (binary は md_binary.py で書き出した .mdb を読む)')
+    parser.add_argument('--layout', choices=('map', 'dense', 'columns'), default=DEFAULT_OPTIONS['layout'],
+        help='Repositoryのデータ構造 (dense は ID - begin を添字にした配列、columns は field ごとの配列)')
+    parser.add_argument('--compact', action='store_true',
+        help='Masterのメンバを詰めて並べ、stringを共通の文字列プールに持たせる')
+
+# id_mgr を渡すとそれを使う (無ければ dense 時に id.toml を読む)
+def make_options(repository:str, layout:str, id_mgr:IdManager=None, compact:bool=False) -> dict:
+    options = dict(DEFAULT_OPTIONS, repository=repository, layout=layout, compact=compact)
+    if layout == 'dense':
+        if id_mgr == None:
+            id_mgr = IdManager()
+        options['id_begins'] = {info.name: info.begin for info in id_mgr.infos}
+    return options
 
 if __name__ == "__main__":
     basicConfig(level=INFO)
-    args = sys.argv
-    IS_DEBUG = len(args) > 1 and args[1] == 'debug'
+    parser = argparse.ArgumentParser(description='masterdata.toml から hpp/cpp を生成する')
+    parser.add_argument('mode', nargs='?', choices=('debug', 'incremental'),
+        help='debug: 書き込まずに出力内容をprintする / incremental: 型定義が変わった型だけを生成し直す')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='生成の並列数 (0ならCPUコア数)')
+    add_option_arguments(parser)
+    parser.add_argument('--dry-run', action='store_true',
+        help='書き込まずに、出力先との差分 (追加・変更・削除されるファイル) の一覧を表示する')
+    parser.add_argument('--no-cache', action='store_true',
+        help='パース済みtomlのキャッシュを使わない')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    if args.no_cache:
+        TomlCache.set_enabled(False)
+    if args.profile:
+        Profiler.enable()
+    IS_DEBUG = args.mode == 'debug'
+    IS_DRY_RUN = args.dry_run
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    options = make_options(args.repository, args.layout, compact=args.compact)
 
     dest_dir = KanjiPath.absolute('md_header')
-    if not IS_DEBUG and os.path.isdir(dest_dir):
-        shutil.rmtree(dest_dir)
     mgr = MDTypeManager()
-    create_cpp_sources(mgr, dest_dir)
+    if args.mode == 'incremental':
+        succeeded = create_cpp_sources_incremental(mgr, dest_dir, jobs, options)
+    else:
+        succeeded = create_cpp_sources(mgr, dest_dir, jobs, clean=True, options=options)
+    Profiler.report(args.profile_output)
+    sys.exit(0 if succeeded else 1)
@@ -1,162 +1,755 @@
 #!/usr/bin/python3
 #coding:utf-8
 
+import itertools
 from master_type import MDTypeInfo
+from md_binary import MDBinaryLayout
+from cpp_template import CppTemplate, SourceWriter
+from profiler import Profiler
+
+# 生成されるコードの形が変わるような修正をしたら上げる
+# build_schema.py の差分ビルドはこの値が変わると全型を生成し直す
+GENERATOR_VERSION = 4
 
 class CppSourceGeneratorBase:
-    def __init__(self, indent:str):
+    BUILD_INFO = CppTemplate('// This file is generated from $name.toml\n')
+    NAMESPACE_BEGIN = 'namespace kanji {\nnamespace md {\n'
+    NAMESPACE_END = '}\n}\n'
+    STORE_MAP = CppTemplate('''\
+        m_data.emplace($key,
+            std::make_shared<kanji::md::Master$name>(
+''')
+    STORE = CppTemplate('''\
+        store($key_int,
+            kanji::md::Master$name(
+''')
+
+    # dense_id_begin: Repository を ID - begin で引く配列にする場合の主キーIDの開始値
+    #                 None なら dx::md::MasterDataRepository (主キーをキーにした連想配列) を使う
+    # columns: Repository を field ごとの配列 (struct of arrays) にする
+    # generator はファイルごとの状態を持たないので、同じものを何度 generate に使ってもよい
+    def __init__(self, indent:str, dense_id_begin:int=None, columns:bool=False):
         self.indent = indent
-        self.build_info:str
-        self.preprocessor:str
-        self.namespace_begin:str
-        self.namespace_end:str
-        self.class_body:str
+        self.dense_id_begin = dense_id_begin
+        self.columns = columns
 
-    # 5つに分けて生成し、最後に結合する
+    # 5つに分けて書き出す
     # 分けた5つのうちファイルごとに異なる部分はサブクラスでオーバーライド
     def generate(self, md_type_info:MDTypeInfo) -> str:
-        self.generate_class_body(md_type_info.data_type_name, md_type_info.fields)
-        self.generate_build_info(md_type_info.data_type_name)
-        self.generate_preprocessor(md_type_info)
-        self.generate_namespace_begin()
-        self.generate_namespace_end()
-        return self.concatenate()
-
-    def concatenate(self) -> str:
-        full_text  = self.build_info
-        full_text += self.preprocessor + '\n'
-        full_text += self.namespace_begin + '\n'
-        full_text += self.class_body + '\n'
-        full_text += self.namespace_end + '\n'
-        return full_text
-
-    def generate_build_info(self, data_type_name:str):
-        self.build_info = '// This file is generated from %s.toml\n' % data_type_name
-
-    def generate_preprocessor(self, md_type_info:MDTypeInfo):
+        with Profiler.span('%s.generate' % type(self).__name__, 'generate', type=md_type_info.data_type_name):
+            return self.generate_impl(md_type_info)
+
+    def generate_impl(self, md_type_info:MDTypeInfo) -> str:
+        out = SourceWriter(self.indent)
+        self.write_build_info(out, md_type_info)
+        self.write_preprocessor(out, md_type_info)
+        out.write('\n')
+        self.write_namespace_begin(out)
+        out.write('\n')
+        self.write_class_body(out, md_type_info)
+        out.write('\n')
+        self.write_namespace_end(out)
+        out.write('\n')
+        return out.getvalue()
+
+    def write_build_info(self, out:SourceWriter, md_type_info:MDTypeInfo):
+        out.render(CppSourceGeneratorBase.BUILD_INFO, name=md_type_info.data_type_name)
+
+    def write_preprocessor(self, out:SourceWriter, md_type_info:MDTypeInfo):
         pass
 
-    def generate_namespace_begin(self):
-        self.namespace_begin  = 'namespace kanji {\n'
-        self.namespace_begin += 'namespace md {\n'
+    def write_namespace_begin(self, out:SourceWriter):
+        out.write(CppSourceGeneratorBase.NAMESPACE_BEGIN)
 
-    def generate_namespace_end(self):
-        self.namespace_end  = '}\n'
-        self.namespace_end += '}\n'
+    def write_namespace_end(self, out:SourceWriter):
+        out.write(CppSourceGeneratorBase.NAMESPACE_END)
 
-    def generate_class_body(self, data_type_name:str, field_dict:dict):
+    def write_class_body(self, out:SourceWriter, md_type_info:MDTypeInfo):
         pass
 
-    def to_camel_case(self, snake_str:str):
+    # Repository の initialize() 内で1レコード分を登録する式の書き出し
+    # key_int: 主キーの int 値の式 / key: 主キーの式
+    def generate_store_begin(self, data_type_name:str, key_int:str, key:str) -> str:
+        if self.dense_id_begin is None and not self.columns:
+            return CppSourceGeneratorBase.STORE_MAP.render(self.indent, key=key, name=data_type_name)
+        return CppSourceGeneratorBase.STORE.render(self.indent, key_int=key_int, name=data_type_name)
+
+    @staticmethod
+    def to_camel_case(snake_str:str):
         first, *others = snake_str.split('_')
         return ''.join([first.lower(), *map(str.title, others)])
 
+    @staticmethod
+    def primary_key(md_type_info:MDTypeInfo):
+        for field in md_type_info.fields.values():
+            if field.is_primary_key:
+                return field
+        return None
+
+
+# field の型と属性 (ID・主キー) だけで決まるコード片
+# 同じ (type_name, attributes) の field は全型・全出力で同じ FieldFragment を使い、
+# C++ の型や読み込み式など field 名によらない部分を埋めたテンプレートを使い回す
+# field 名 (と .mdb 内のオフセット) まで同じコード片は描画済みの文字列をそのまま返す
+class FieldFragment:
+    TEMPLATES = {
+        'getter': CppTemplate('    $pass_type $camel() const { return m_$name; }\n'),
+        'member': CppTemplate('    $raw_type m_$name;\n'),
+        'param': CppTemplate('$pass_type $name'),
+        'init': CppTemplate('    m_$name($name)'),
+        'pooled_getter': CppTemplate('    $pass_type $camel() const { return MasterStringPool::at(m_$name); }\n'),
+        'pooled_member': CppTemplate('    std::uint32_t m_$name;\n'),
+        'pooled_init': CppTemplate('    m_$name(MasterStringPool::intern($name))'),
+        'column_getter': CppTemplate('    const std::vector<$raw_type>& $camel() const { return m_$name; }\n'),
+        'column_member': CppTemplate('    std::vector<$raw_type> m_$name;\n'),
+        'column_push': CppTemplate('        m_$name.push_back(record.$camel());\n'),
+        'toml_id': CppTemplate('                $raw_type(toml_value[U"$name"].get<int>())'),
+        'toml_class': CppTemplate('                dx::toml::$class_type(toml_value[U"$name"])'),
+        'toml_value': CppTemplate('                toml_value[U"$name"].get<$raw_type>()'),
+        'binary_id': CppTemplate('$raw_type(readMasterBinary<std::int32_t>(record + $offset))'),
+        'binary_string': CppTemplate('readMasterBinaryString(string_pool, record + $offset)'),
+        'binary_vec2': CppTemplate('s3d::Vec2(readMasterBinary<double>(record + $offset), readMasterBinary<double>(record + $offset_y))'),
+        'binary_value': CppTemplate('readMasterBinary<$read_type>(record + $offset)'),
+    }
+    # (type_name, is_id, is_primary_key) -> FieldFragment
+    cache = dict()
+    # (kind, indent) -> { (type_name, is_id, is_primary_key, name, offset): 描画済みの文字列 }
+    rendered = dict()
+
+    def __init__(self, field):
+        pooled = DataHppGenerator.is_pooled(field)
+        self.values = {
+            'raw_type': field.raw_type,
+            'pass_type': field.pass_type,
+            'class_type': RepositoryCppGenerator.CLASS_TYPE.get(field.type_name),
+            'read_type': RepositoryBinaryCppGenerator.READ_TYPES.get(MDBinaryLayout.field_format(field))}
+        if field.is_id:
+            toml_value, binary_value = 'toml_id', 'binary_id'
+        elif field.type_name == 'string':
+            toml_value, binary_value = 'toml_value', 'binary_string'
+        elif field.type_name == 'Vec2':
+            toml_value, binary_value = 'toml_class', 'binary_vec2'
+        else:
+            toml_value, binary_value = 'toml_value', 'binary_value'
+        # 生成側が使う名前 -> TEMPLATES の名前 (同じ名前のものは省略)
+        self.kinds = {
+            'compact_getter': 'pooled_getter' if pooled else 'getter',
+            'compact_member': 'pooled_member' if pooled else 'member',
+            'compact_init': 'pooled_init' if pooled else 'init',
+            'toml_value': toml_value,
+            'binary_value': binary_value}
+        # (kind, indent) -> 型ごとの値を埋めた CompiledTemplate
+        self.bound = dict()
+
+    @classmethod
+    def of(cls, field):
+        key = (field.type_name, field.is_id, field.is_primary_key)
+        fragment = cls.cache.get(key)
+        if fragment == None:
+            fragment = cls(field)
+            cls.cache[key] = fragment
+        return fragment
+
+    # fields の各 field のコード片のリスト
+    # offsets: fields と同じ順の .mdb のレコード先頭からのオフセット (binary_value のみ)
+    @classmethod
+    def render_fields(cls, kind:str, indent:str, fields, offsets=None) -> list:
+        rendered = cls.rendered.get((kind, indent))
+        if rendered == None:
+            rendered = dict()
+            cls.rendered[(kind, indent)] = rendered
+        texts = list()
+        for field, offset in zip(fields, offsets if offsets != None else itertools.repeat(None)):
+            key = (field.type_name, field.is_id, field.is_primary_key, field.name, offset)
+            text = rendered.get(key)
+            if text == None:
+                text = cls.of(field).render(kind, indent, field.name, offset)
+                rendered[key] = text
+            texts.append(text)
+        return texts
+
+    def render(self, kind:str, indent:str, name:str, offset:int=None) -> str:
+        template = self.bound.get((kind, indent))
+        if template == None:
+            template = FieldFragment.TEMPLATES[self.kinds.get(kind, kind)].compile(indent).bind(self.values)
+            self.bound[(kind, indent)] = template
+        return template.render({
+            'name': name,
+            'camel': CppSourceGeneratorBase.to_camel_case(name),
+            'offset': offset,
+            'offset_y': offset + 8 if offset != None else None})
+
 
 class DataHppGenerator(CppSourceGeneratorBase):
-    def generate_preprocessor(self, md_type_info:MDTypeInfo):
-        need_ids_hpp = False
-        for field in md_type_info.fields.values():
-            if field.is_id:
-                need_ids_hpp = True
-        self.preprocessor = '#pragma once\n'
-        if need_ids_hpp:
-            self.preprocessor += '#include "IDs.hpp"\n'
+    # compact 時の (サイズ, アライメント)。string は MasterStringPool の添字、IDは int32 の enum とみなす
+    COMPACT_LAYOUT = {'int': (4, 4), 'float': (4, 4), 'double': (8, 8), 'string': (4, 4), 'Vec2': (16, 8)}
+    ID_LAYOUT = (4, 4)
+    # e.g. getters: const s3d::String& label() const { return m_label; }
+    #      members: s3d::String m_label;
+    #      params:  const s3d::String& label, ...
+    #      inits:   m_label(label), ...
+    CLASS_BODY = CppTemplate('''\
+class Master$name {
+public: // public getter
+${getters}private: // field
+${members}public: // ctor
+    Master$name($params) :
+$inits {}
+};
+''')
+    STATIC_ASSERT = CppTemplate('static_assert(sizeof(Master$name) == $size, "Master$name has unexpected padding");\n')
+
+    # compact: メンバをアライメントの大きい順に並べ、string は MasterStringPool の添字で持つ
+    #          レイアウトが想定どおりかを static_assert(sizeof) で確かめる
+    def __init__(self, indent:str, compact:bool=False):
+        super().__init__(indent)
+        self.compact = compact
+
+    def write_preprocessor(self, out:SourceWriter, md_type_info:MDTypeInfo):
+        out.write('#pragma once\n')
+        if any(field.is_id for field in md_type_info.fields.values()):
+            out.write('#include "IDs.hpp"\n')
         for include_file in md_type_info.include_files():
-            self.preprocessor += '#include %s\n' % include_file
-
-    def generate_class_body(self, data_type_name:str, field_dict:dict):
-        getters = ''
-        fields = ''
-        ctor_declaration = self.indent + 'Master%s(' % data_type_name
-        ctor_definition = ''
-        for field in field_dict.values():
-            raw_type = field.raw_type
-            pass_type = field.pass_type
-            # e.g. const s3d::String& label() const { return m_label; }
-            getters += self.indent + '%s %s() const { return m_%s; }\n' % (pass_type, self.to_camel_case(field.name), field.name)
-            # e.g. s3d::String m_label;
-            fields  += self.indent + '%s m_%s;\n' % (raw_type, field.name)
-            # e.g. MasterHoge(const s3d::String& label, ... ):
-            ctor_declaration += '%s %s, ' % (pass_type, field.name)
-            # e.g. m_label(label), ... {}
-            ctor_definition += self.indent + 'm_%s(%s),\n' % (field.name, field.name)
-        ctor_declaration = ctor_declaration.rstrip(', ')
-        ctor_declaration += ') :\n'
-        ctor_definition = ctor_definition.rstrip(',\n')
-        ctor_definition += ' {}\n'
-        self.generateClassBodyImpl(data_type_name, getters, fields, ctor_declaration + ctor_definition)
-
-    def generateClassBodyImpl(self, data_type_name:str, getter:str, field:str, constructor:str):
-        self.class_body  = 'class Master%s {\n' % data_type_name
-        self.class_body += 'public: // public getter\n'
-        self.class_body += getter
-        self.class_body += 'private: // field\n'
-        self.class_body += field
-        self.class_body += 'public: // ctor\n'
-        self.class_body += constructor
-        self.class_body += '};\n'
+            out.write('#include %s\n' % include_file)
+        if self.compact and any(DataHppGenerator.is_pooled(field) for field in md_type_info.fields.values()):
+            out.write('#include <cstdint>\n')
+            out.write('#include "MasterStringPool.hpp"\n')
+
+    # compact 時も getter とコンストラクタの引数は toml の宣言順のまま (Repository 側の生成コードは共通)
+    # メンバの宣言と初期化子はアライメントの大きい順
+    def write_class_body(self, out:SourceWriter, md_type_info:MDTypeInfo):
+        indent = self.indent
+        fields = md_type_info.fields.values()
+        if self.compact:
+            prefix = 'compact_'
+            members = DataHppGenerator.compact_order(md_type_info.fields)
+        else:
+            prefix = ''
+            members = fields
+        out.render(DataHppGenerator.CLASS_BODY,
+            name=md_type_info.data_type_name,
+            getters=''.join(FieldFragment.render_fields(prefix + 'getter', indent, fields)),
+            members=''.join(FieldFragment.render_fields(prefix + 'member', indent, members)),
+            params=', '.join(FieldFragment.render_fields('param', indent, fields)),
+            inits=',\n'.join(FieldFragment.render_fields(prefix + 'init', indent, members)))
+        if self.compact:
+            out.render(DataHppGenerator.STATIC_ASSERT, name=md_type_info.data_type_name, size=DataHppGenerator.compact_size(md_type_info.fields))
+
+    @staticmethod
+    def is_pooled(field) -> bool:
+        return field.type_name == 'string' and not field.is_id
+
+    @staticmethod
+    def field_layout(field) -> tuple:
+        if field.is_id:
+            return DataHppGenerator.ID_LAYOUT
+        return DataHppGenerator.COMPACT_LAYOUT[field.type_name]
+
+    # アライメントの大きい順 (同じなら宣言順) に並べると、メンバ間に詰め物が入らない
+    @staticmethod
+    def compact_order(field_dict:dict) -> list:
+        return sorted(field_dict.values(), key=lambda field: -DataHppGenerator.field_layout(field)[1])
+
+    # 末尾の詰め物を含めた sizeof
+    @staticmethod
+    def compact_size(field_dict:dict) -> int:
+        layouts = [DataHppGenerator.field_layout(field) for field in field_dict.values()]
+        alignment = max((align for _, align in layouts), default=1)
+        size = sum(size for size, _ in layouts)
+        return (size + alignment - 1) // alignment * alignment
 
 
 class RepositoryHppGenerator(CppSourceGeneratorBase):
-    def generate_preprocessor(self, md_type_info:MDTypeInfo):
-        need_ids_hpp = False
-        for field in md_type_info.fields.values():
-            if field.is_id:
-                need_ids_hpp = True
-        self.preprocessor  = '#pragma once\n'
-        self.preprocessor += '#include "Singleton.hpp"\n'
-        self.preprocessor += '#include "MasterDataRepository.hpp"\n'
-        self.preprocessor += '#include "Master%s.hpp"\n' % md_type_info.data_type_name
+    # dense 時に ID から int を取り出す式
+    ID_TO_INT = 'static_cast<std::int32_t>(%s)'
+    MAP_CLASS_BODY = CppTemplate('''\
+class Master${name}Repository :
+    public dx::md::MasterDataRepository<$key_type, Master$name>,
+    public dx::cmp::Singleton<Master${name}Repository> {
+protected: // protected function
+    void initialize();
+public: // ctor
+    Master${name}Repository() { initialize(); }
+};
+''')
+    # dense: ID - begin を添字にした配列に実体を直接並べる (レコードごとの shared_ptr を作らない)
+    DENSE_CLASS_BODY = CppTemplate('''\
+class Master${name}Repository :
+    public dx::cmp::Singleton<Master${name}Repository> {
+public: // public function
+    // 範囲外、またはデータが無い場合は nullptr
+    const Master$name* at(const $key_type& id) const {
+        const std::size_t index = static_cast<std::size_t>($id_int - ID_BEGIN);
+        return index < m_data.size() && m_data[index] ? &*m_data[index] : nullptr;
+    }
+    const std::vector<std::optional<Master$name>>& data() const { return m_data; }
+private: // field
+    static constexpr std::int32_t ID_BEGIN = $id_begin;
+    std::vector<std::optional<Master$name>> m_data;
+protected: // protected function
+    void initialize();
+    void store(std::int32_t id, Master$name&& record) {
+        const std::size_t index = static_cast<std::size_t>(id - ID_BEGIN);
+        if (m_data.size() <= index) { m_data.resize(index + 1); }
+        m_data[index].emplace(std::move(record));
+    }
+public: // ctor
+    Master${name}Repository() { initialize(); }
+};
+''')
+    # columns: field ごとの std::vector に値を並べる (struct of arrays)
+    # 1つの field だけを全レコード分なめる処理向け。主キーからは indexOf で行を引く
+    COLUMNS_CLASS_BODY = CppTemplate('''\
+class Master${name}Repository :
+    public dx::cmp::Singleton<Master${name}Repository> {
+public: // public function
+    std::size_t size() const { return m_$key.size(); }
+    // 主キーのレコードが何行目か。無ければ std::nullopt
+    std::optional<std::size_t> indexOf($key_pass_type $key) const {
+        const auto found = m_index.find($key_int);
+        return found == m_index.end() ? std::nullopt : std::optional<std::size_t>(found->second);
+    }
+${getters}private: // field
+    std::unordered_map<std::int32_t, std::size_t> m_index;
+${members}protected: // protected function
+    void initialize();
+    void store(std::int32_t id, Master$name&& record) {
+        m_index.emplace(id, m_$key.size());
+${pushes}    }
+public: // ctor
+    Master${name}Repository() { initialize(); }
+};
+''')
+
+    def write_preprocessor(self, out:SourceWriter, md_type_info:MDTypeInfo):
+        need_ids_hpp = any(field.is_id for field in md_type_info.fields.values())
+        out.write('#pragma once\n')
+        if self.columns:
+            out.write('#include <cstdint>\n')
+            out.write('#include <optional>\n')
+            out.write('#include <unordered_map>\n')
+            out.write('#include <vector>\n')
+            out.write('#include "Singleton.hpp"\n')
+        elif self.dense_id_begin is None:
+            out.write('#include "Singleton.hpp"\n')
+            out.write('#include "MasterDataRepository.hpp"\n')
+        else:
+            out.write('#include <cstdint>\n')
+            out.write('#include <optional>\n')
+            out.write('#include <vector>\n')
+            out.write('#include "Singleton.hpp"\n')
+            need_ids_hpp = True
+        out.write('#include "Master%s.hpp"\n' % md_type_info.data_type_name)
         if need_ids_hpp:
-            self.preprocessor += '#include "IDs.hpp"\n'
+            out.write('#include "IDs.hpp"\n')
 
-    def generate_class_body(self, data_type_name:str, field_dict:dict):
-        primary_key_type = None
-        for field in field_dict.values():
-            if field.is_primary_key:
-                primary_key_type = field.raw_type
-        self.class_body  = 'class Master%sRepository :\n' % data_type_name
-        self.class_body += self.indent + 'public dx::md::MasterDataRepository<%s, Master%s>,\n' % (primary_key_type, data_type_name)
-        self.class_body += self.indent + 'public dx::cmp::Singleton<Master%sRepository> {\n' % data_type_name
-        self.class_body += 'protected: // protected function\n'
-        self.class_body += self.indent + 'void initialize();\n'
-        self.class_body += 'public: // ctor\n'
-        self.class_body += self.indent + 'Master%sRepository() { initialize(); }\n' % data_type_name
-        self.class_body += '};\n'
+    def write_class_body(self, out:SourceWriter, md_type_info:MDTypeInfo):
+        primary_key = CppSourceGeneratorBase.primary_key(md_type_info)
+        if self.columns:
+            self.write_class_body_columns(out, md_type_info, primary_key)
+        elif self.dense_id_begin is None:
+            out.render(RepositoryHppGenerator.MAP_CLASS_BODY,
+                name=md_type_info.data_type_name,
+                key_type=primary_key.raw_type if primary_key != None else None)
+        else:
+            out.render(RepositoryHppGenerator.DENSE_CLASS_BODY,
+                name=md_type_info.data_type_name,
+                key_type=primary_key.raw_type if primary_key != None else None,
+                id_int=RepositoryHppGenerator.ID_TO_INT % 'id',
+                id_begin='%d' % self.dense_id_begin)
+
+    def write_class_body_columns(self, out:SourceWriter, md_type_info:MDTypeInfo, primary_key):
+        indent = self.indent
+        fields = md_type_info.fields.values()
+        out.render(RepositoryHppGenerator.COLUMNS_CLASS_BODY,
+            name=md_type_info.data_type_name,
+            key=primary_key.name,
+            key_pass_type=primary_key.pass_type,
+            key_int=RepositoryHppGenerator.ID_TO_INT % primary_key.name,
+            getters=''.join(FieldFragment.render_fields('column_getter', indent, fields)),
+            members=''.join(FieldFragment.render_fields('column_member', indent, fields)),
+            pushes=''.join(FieldFragment.render_fields('column_push', indent, fields)))
 
 
 class RepositoryCppGenerator(CppSourceGeneratorBase):
     CLASS_TYPE = {'Vec2': 'vec2'}
+    CLASS_BODY = CppTemplate('''\
+void Master${name}Repository::initialize() {
+    const dx::toml::TomlAsset toml(U"$name");
+    const dx::toml::TomlKey key(U"masterdata");
+    s3d::TOMLTableView table = toml[key].tableView();
+    for (const s3d::TOMLTableMember& table_member : table) {
+        const auto& toml_value = table_member.value;
+${store}$values));
+    }
+}
+''')
 
-    def generate_preprocessor(self, md_type_info:MDTypeInfo):
-        self.preprocessor  = '#include "Master%sRepository.hpp"\n' % md_type_info.data_type_name
-        self.preprocessor += '#include "TomlAsset.hpp"\n'
+    def write_preprocessor(self, out:SourceWriter, md_type_info:MDTypeInfo):
+        out.write('#include "Master%sRepository.hpp"\n' % md_type_info.data_type_name)
+        out.write('#include "TomlAsset.hpp"\n')
 
-    def generate_class_body(self, data_type_name:str, field_dict:dict):
-        primary_key = None
-        for field in field_dict.values():
-            if field.is_primary_key:
-                primary_key = field
-        self.class_body  = 'void Master%sRepository::initialize() {\n' % data_type_name
-        self.class_body += self.indent + 'const dx::toml::TomlAsset toml(U"%s");\n' % (data_type_name)
-        self.class_body += self.indent + 'const dx::toml::TomlKey key(U"masterdata");\n'
-        self.class_body += self.indent + 's3d::TOMLTableView table = toml[key].tableView();\n'
-        self.class_body += self.indent + 'for (const s3d::TOMLTableMember& table_member : table) {\n'
-        self.class_body += self.indent * 2 + 'const auto& toml_value = table_member.value;\n'
+    def write_class_body(self, out:SourceWriter, md_type_info:MDTypeInfo):
+        indent = self.indent
+        primary_key = CppSourceGeneratorBase.primary_key(md_type_info)
         # 主キー
-        self.class_body += self.indent * 2 + 'm_data.emplace(%s(toml_value[U"%s"].get<int>()),\n' % (primary_key.raw_type, primary_key.name)
-        self.class_body += self.indent * 3 + 'std::make_shared<kanji::md::Master%s>(\n' % data_type_name
+        key_int = 'toml_value[U"%s"].get<int>()' % primary_key.name
+        store = self.generate_store_begin(md_type_info.data_type_name, key_int, '%s(%s)' % (primary_key.raw_type, key_int))
         # メンバ変数
-        fields_str = ''
-        for field in field_dict.values():
-            if field.is_id:
-                fields_str += self.indent * 4 + '%s(toml_value[U"%s"].get<int>()),\n' % (field.raw_type, field.name)
-            elif field.type_name in RepositoryCppGenerator.CLASS_TYPE:
-                fields_str += self.indent * 4 + 'dx::toml::%s(toml_value[U"%s"]),\n' % (RepositoryCppGenerator.CLASS_TYPE[field.type_name], field.name)
-            else:
-                fields_str += self.indent * 4 + 'toml_value[U"%s"].get<%s>(),\n' % (field.name, field.raw_type)
-        fields_str = fields_str.rstrip(',\n') + '));\n'
-        self.class_body += fields_str
-        self.class_body += self.indent + '}\n'
-        self.class_body += '}\n'
+        out.render(RepositoryCppGenerator.CLASS_BODY,
+            name=md_type_info.data_type_name,
+            store=store,
+            values=',\n'.join(FieldFragment.render_fields('toml_value', indent, md_type_info.fields.values())))
+
+
+# md_binary.py が書き出した .mdb を読み込む Repository の cpp
+# RepositoryCppGenerator の代わりに使う (hpp は共通)
+class RepositoryBinaryCppGenerator(CppSourceGeneratorBase):
+    # クライアントの作業ディレクトリから見た .mdb の置き場所
+    BINARY_DIRECTORY = 'KANJI-asset/schema/master_binary/'
+    READ_TYPES = {'i': 'std::int32_t', 'f': 'float', 'd': 'double'}
+    HELPERS = CppTemplate('''\
+namespace {
+template <class T>
+T readMasterBinary(const std::uint8_t* p) {
+    T value;
+    std::memcpy(&value, p, sizeof(T));
+    return value;
+}
+s3d::String readMasterBinaryString(const char* string_pool, const std::uint8_t* p) {
+    return s3d::Unicode::FromUTF8(std::string_view(
+        string_pool + readMasterBinary<std::uint32_t>(p),
+        readMasterBinary<std::uint32_t>(p + 4)));
+}
+}
+
+''')
+    # ヘッダと型定義を確認してから、レコードを順に登録する
+    CLASS_BODY = CppTemplate('''\
+void Master${name}Repository::initialize() {
+    const s3d::Blob blob(U"$directory$path");
+    const std::uint8_t* const data = reinterpret_cast<const std::uint8_t*>(blob.data());
+    if (blob.size() < $header_size ||
+        std::memcmp(data, "$magic", $magic_size) != 0 ||
+        readMasterBinary<std::uint32_t>(data + $version_offset) != ${version}u ||
+        readMasterBinary<std::uint32_t>(data + $schema_hash_offset) != 0x${schema_hash}u ||
+        readMasterBinary<std::uint32_t>(data + $record_size_offset) != ${record_size}u) {
+        throw s3d::Error(U"master binary does not match Master$name: $path");
+    }
+    const std::uint32_t record_count = readMasterBinary<std::uint32_t>(data + $record_count_offset);
+    const char* const string_pool = reinterpret_cast<const char*>(data + readMasterBinary<std::uint32_t>(data + $string_pool_offset));
+${records}${store}$values));
+    }
+}
+''')
+    # 主キーが int / ID の型: id table の (主キー, オフセット) をたどってレコードを引く
+    ID_TABLE_RECORDS = CppTemplate('''    const std::uint32_t id_table_offset = readMasterBinary<std::uint32_t>(data + $id_table_offset);
+    if (id_table_offset == 0 || id_table_offset > blob.size() || (blob.size() - id_table_offset) / $id_entry_size < record_count) {
+        throw s3d::Error(U"master binary has no valid id table: $path");
+    }
+    const std::uint8_t* const id_table = data + id_table_offset;
+    for (std::uint32_t i = 0; i < record_count; ++i) {
+        const std::uint8_t* const entry = id_table + i * $id_entry_size;
+        const std::uint8_t* const record = data + readMasterBinary<std::uint32_t>(entry + 4);
+''')
+    # それ以外の型: レコードを先頭から順に読む
+    SEQUENTIAL_RECORDS = CppTemplate('''    const std::uint8_t* const records = data + readMasterBinary<std::uint32_t>(data + $records_offset);
+    for (std::uint32_t i = 0; i < record_count; ++i) {
+        const std::uint8_t* const record = records + i * $record_size;
+''')
+
+    # binary_path: BINARY_DIRECTORY からの相対パス e.g. 'kanji/KanjiParam.mdb'
+    def __init__(self, indent:str, binary_path:str, dense_id_begin:int=None, columns:bool=False):
+        super().__init__(indent, dense_id_begin, columns)
+        self.binary_path = binary_path
+
+    def write_preprocessor(self, out:SourceWriter, md_type_info:MDTypeInfo):
+        out.write('#include "Master%sRepository.hpp"\n' % md_type_info.data_type_name)
+        out.write('#include <cstdint>\n')
+        out.write('#include <cstring>\n')
+        out.write('#include <string_view>\n')
+        out.write('#include <Siv3D/Blob.hpp>\n')
+        out.write('#include <Siv3D/Error.hpp>\n')
+        out.write('#include <Siv3D/Unicode.hpp>\n')
+
+    def write_class_body(self, out:SourceWriter, md_type_info:MDTypeInfo):
+        indent = self.indent
+        header_offset = MDBinaryLayout.header_offset
+        layout = MDBinaryLayout(md_type_info)
+        # e.g. readMasterBinary<float>(record + 12)
+        fields = [field for field, _, _ in layout.fields]
+        values = FieldFragment.render_fields('binary_value', indent, fields, [offset for _, offset, _ in layout.fields])
+        # 主キー
+        primary_key = md_type_info.fields[md_type_info.primary_key]
+        key = values[fields.index(primary_key)]
+        if layout.has_id_table:
+            key_int = 'readMasterBinary<std::int32_t>(entry)'
+            records = RepositoryBinaryCppGenerator.ID_TABLE_RECORDS.render(indent,
+                id_table_offset=header_offset('id_table_offset'),
+                id_entry_size=MDBinaryLayout.ID_ENTRY.size,
+                path=self.binary_path)
+        else:
+            key_offset, _ = layout.field_offset(primary_key.name)
+            key_int = 'readMasterBinary<std::int32_t>(record + %d)' % key_offset
+            records = RepositoryBinaryCppGenerator.SEQUENTIAL_RECORDS.render(indent,
+                records_offset=header_offset('records_offset'),
+                record_size=layout.record_size)
+        out.render(RepositoryBinaryCppGenerator.HELPERS)
+        out.render(RepositoryBinaryCppGenerator.CLASS_BODY,
+            name=md_type_info.data_type_name,
+            directory=RepositoryBinaryCppGenerator.BINARY_DIRECTORY,
+            path=self.binary_path,
+            header_size=MDBinaryLayout.HEADER.size,
+            magic=MDBinaryLayout.MAGIC.decode('ascii'),
+            magic_size=len(MDBinaryLayout.MAGIC),
+            version_offset=header_offset('version'),
+            version=MDBinaryLayout.VERSION,
+            schema_hash_offset=header_offset('schema_hash'),
+            schema_hash='%08x' % layout.schema_hash,
+            record_size_offset=header_offset('record_size'),
+            record_size=layout.record_size,
+            record_count_offset=header_offset('record_count'),
+            string_pool_offset=header_offset('string_pool_offset'),
+            records=records,
+            store=self.generate_store_begin(md_type_info.data_type_name, key_int, key),
+            # メンバ変数
+            values=',\n'.join(indent * 4 + value for value in values))
+
+
+# 型ごとではなく、全型の MDTypeInfo のリストから1ファイルを生成するもの
+class SharedSourceGeneratorBase(CppSourceGeneratorBase):
+    BUILD_INFO = '// This file is generated from masterdata.toml\n'
+
+    def generate(self, type_infos:list) -> str:
+        with Profiler.span('%s.generate' % type(self).__name__, 'generate', types=len(type_infos)):
+            return self.generate_impl(type_infos)
+
+    def write_build_info(self, out:SourceWriter, type_infos:list):
+        out.write(SharedSourceGeneratorBase.BUILD_INFO)
+
+
+# 全型の Repository をまとめた MasterDataLoader の hpp/cpp
+# ロード画面などで preloadAll / preloadAllAsync を呼ぶと lazy でない Repository をスレッドプールで並列に読み込む
+# lazy な型 (masterdata.toml で lazy = true) は従来どおり初めて使われたときに読み込む
+class MasterDataLoaderHppGenerator(SharedSourceGeneratorBase):
+    PREPROCESSOR = '''\
+#pragma once
+#include <array>
+#include <chrono>
+#include <cstddef>
+#include <functional>
+#include <future>
+#include <string_view>
+'''
+    CLASS_BODY = CppTemplate('''\
+class MasterDataLoader {
+public: // type
+    struct Entry {
+        std::string_view name;
+        void (*load)();
+        bool lazy;
+    };
+    // Repository を1つ読み込み終えるたびに、読み込んだスレッドから呼ばれる
+    using TimingHook = std::function<void(std::string_view name, std::chrono::nanoseconds elapsed)>;
+public: // public function
+    // lazy でない Repository をすべて threads 並列で読み込む (0 ならハードウェアスレッド数)
+    // 読み込み中の例外は全スレッドの終了後に最初のものを投げ直す
+    static void preloadAll(std::size_t threads = 0, const TimingHook& hook = nullptr);
+    // preloadAll を別スレッドで行う (ロード画面の裏で読み込み、loadedCount で進捗を見る)
+    static std::future<void> preloadAllAsync(std::size_t threads = 0, TimingHook hook = nullptr);
+    // 型名 (e.g. "KanjiParam") で1つ読み込む。無い型名なら false
+    // 読み込み済みの型は読み込み直さず、hook も呼ばない (読み込み中なら終わるまで待つ)
+    static bool load(std::string_view name, const TimingHook& hook = nullptr);
+    // preloadAll / load で読み込み終えた型の数 (同じ型は1度だけ数える) と、preloadAll で読み込む数
+    static std::size_t loadedCount();
+    static constexpr std::size_t preloadCount() { return $preload_count; }
+public: // field
+    static const std::array<Entry, $count> ENTRIES;
+};
+''')
+
+    def write_preprocessor(self, out:SourceWriter, type_infos:list):
+        out.write(MasterDataLoaderHppGenerator.PREPROCESSOR)
+
+    def write_class_body(self, out:SourceWriter, type_infos:list):
+        out.render(MasterDataLoaderHppGenerator.CLASS_BODY,
+            preload_count=sum(1 for type_info in type_infos if not type_info.lazy),
+            count=len(type_infos))
+
+
+class MasterDataLoaderCppGenerator(SharedSourceGeneratorBase):
+    # Repository の Singleton の実体を取得する (初回に initialize() が走る) 式
+    SINGLETON_ACCESS = 'Master%sRepository::getInstance()'
+    PREPROCESSOR = '''\
+#include "MasterDataLoader.hpp"
+#include <algorithm>
+#include <atomic>
+#include <exception>
+#include <mutex>
+#include <thread>
+#include <vector>
+'''
+    ENTRY = CppTemplate('    { "$name", [] { $load; }, $lazy },\n')
+    CLASS_BODY = CppTemplate('''\
+namespace {
+std::atomic<std::size_t> loaded_count = 0;
+// ENTRIES と同じ順。初めての読み込みだけを数え・計測する (失敗したら次の呼び出しで読み込み直す)
+std::array<std::once_flag, $count> load_flags;
+void loadTimed(std::size_t index, const MasterDataLoader::TimingHook& hook) {
+    const MasterDataLoader::Entry& entry = MasterDataLoader::ENTRIES[index];
+    bool loaded = false;
+    std::chrono::nanoseconds elapsed{};
+    std::call_once(load_flags[index], [&] {
+        const auto begin = std::chrono::steady_clock::now();
+        entry.load();
+        elapsed = std::chrono::duration_cast<std::chrono::nanoseconds>(std::chrono::steady_clock::now() - begin);
+        loaded = true;
+    });
+    if (!loaded) { return; }
+    ++loaded_count;
+    if (hook) { hook(entry.name, elapsed); }
+}
+}
+
+const std::array<MasterDataLoader::Entry, $count> MasterDataLoader::ENTRIES = {{
+${entries}}};
+
+void MasterDataLoader::preloadAll(std::size_t threads, const TimingHook& hook) {
+    if (threads == 0) { threads = std::max(1u, std::thread::hardware_concurrency()); }
+    std::atomic<std::size_t> next = 0;
+    std::exception_ptr error;
+    std::mutex error_mutex;
+    const auto worker = [&] {
+        for (std::size_t i = next++; i < ENTRIES.size(); i = next++) {
+            if (ENTRIES[i].lazy) { continue; }
+            try {
+                loadTimed(i, hook);
+            } catch (...) {
+                const std::lock_guard<std::mutex> lock(error_mutex);
+                if (!error) { error = std::current_exception(); }
+            }
+        }
+    };
+    std::vector<std::thread> pool;
+    for (std::size_t i = 1; i < std::min(threads, ENTRIES.size()); ++i) { pool.emplace_back(worker); }
+    worker();
+    for (std::thread& thread : pool) { thread.join(); }
+    if (error) { std::rethrow_exception(error); }
+}
+
+std::future<void> MasterDataLoader::preloadAllAsync(std::size_t threads, TimingHook hook) {
+    return std::async(std::launch::async, [threads, hook = std::move(hook)] { preloadAll(threads, hook); });
+}
+
+bool MasterDataLoader::load(std::string_view name, const TimingHook& hook) {
+    for (std::size_t i = 0; i < ENTRIES.size(); ++i) {
+        if (ENTRIES[i].name == name) {
+            loadTimed(i, hook);
+            return true;
+        }
+    }
+    return false;
+}
+
+std::size_t MasterDataLoader::loadedCount() {
+    return loaded_count.load();
+}
+''')
+
+    def write_preprocessor(self, out:SourceWriter, type_infos:list):
+        out.write(MasterDataLoaderCppGenerator.PREPROCESSOR)
+        for type_info in type_infos:
+            out.write('#include "Master%sRepository.hpp"\n' % type_info.data_type_name)
+
+    def write_class_body(self, out:SourceWriter, type_infos:list):
+        entry = MasterDataLoaderCppGenerator.ENTRY.compile(self.indent)
+        out.render(MasterDataLoaderCppGenerator.CLASS_BODY,
+            count=len(type_infos),
+            entries=''.join(entry.render({
+                'name': type_info.data_type_name,
+                'load': MasterDataLoaderCppGenerator.SINGLETON_ACCESS % type_info.data_type_name,
+                'lazy': 'true' if type_info.lazy else 'false'}) for type_info in type_infos))
+
+
+# DataHppGenerator の compact で使う、全 Master 共通の文字列プールの hpp/cpp
+# 同じ文字列は1つだけ持ち、Master は添字 (uint32) だけを持つ
+# 要素は固定長のチャンクに置いて動かさないので、at() はロックせずに参照を返せる
+# intern() は MasterDataLoader の並列読み込みから同時に呼ばれるのでロックする
+class MasterStringPoolHppGenerator(SharedSourceGeneratorBase):
+    PREPROCESSOR = '''\
+#pragma once
+#include <cstddef>
+#include <cstdint>
+#include <Siv3D/String.hpp>
+'''
+    CLASS_BODY = CppTemplate('''\
+class MasterStringPool {
+public: // public function
+    // 同じ文字列が既にあればその添字を返す
+    static std::uint32_t intern(const s3d::String& text);
+    static const s3d::String& at(std::uint32_t index);
+    static std::size_t size();
+};
+''')
+
+    def write_preprocessor(self, out:SourceWriter, type_infos:list):
+        out.write(MasterStringPoolHppGenerator.PREPROCESSOR)
+
+    def write_class_body(self, out:SourceWriter, type_infos:list):
+        out.render(MasterStringPoolHppGenerator.CLASS_BODY)
+
+
+class MasterStringPoolCppGenerator(SharedSourceGeneratorBase):
+    CHUNK_BITS = 12
+    MAX_CHUNKS = 4096
+    PREPROCESSOR = '''\
+#include "MasterStringPool.hpp"
+#include <array>
+#include <memory>
+#include <mutex>
+#include <stdexcept>
+#include <unordered_map>
+'''
+    CLASS_BODY = CppTemplate('''\
+namespace {
+constexpr std::uint32_t CHUNK_BITS = $chunk_bits;
+constexpr std::uint32_t CHUNK_SIZE = 1u << CHUNK_BITS;
+constexpr std::size_t MAX_CHUNKS = $max_chunks;
+std::array<std::unique_ptr<s3d::String[]>, MAX_CHUNKS> chunks;
+// キーはチャンク内の文字列を指す (チャンク内の要素は動かない)
+std::unordered_map<s3d::StringView, std::uint32_t> indices;
+std::uint32_t count = 0;
+std::mutex mutex;
+}
+
+std::uint32_t MasterStringPool::intern(const s3d::String& text) {
+    const std::lock_guard<std::mutex> lock(mutex);
+    const auto found = indices.find(s3d::StringView(text));
+    if (found != indices.end()) { return found->second; }
+    const std::uint32_t index = count;
+    std::unique_ptr<s3d::String[]>& chunk = chunks.at(index >> CHUNK_BITS);
+    if (!chunk) { chunk = std::make_unique<s3d::String[]>(CHUNK_SIZE); }
+    s3d::String& stored = chunk[index & (CHUNK_SIZE - 1)];
+    stored = text;
+    indices.emplace(s3d::StringView(stored), index);
+    ++count;
+    return index;
+}
+
+const s3d::String& MasterStringPool::at(std::uint32_t index) {
+    return chunks[index >> CHUNK_BITS][index & (CHUNK_SIZE - 1)];
+}
+
+std::size_t MasterStringPool::size() {
+    const std::lock_guard<std::mutex> lock(mutex);
+    return count;
+}
+''')
+
+    def write_preprocessor(self, out:SourceWriter, type_infos:list):
+        out.write(MasterStringPoolCppGenerator.PREPROCESSOR)
 
+    def write_class_body(self, out:SourceWriter, type_infos:list):
+        out.render(MasterStringPoolCppGenerator.CLASS_BODY,
+            chunk_bits=MasterStringPoolCppGenerator.CHUNK_BITS,
+            max_chunks=MasterStringPoolCppGenerator.MAX_CHUNKS)
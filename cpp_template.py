@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+#coding:utf-8
+
+import re
+
+# cpp_source_generator.py が使う、コード片のテンプレート
+#   $name / ${name} : 値を差し込む位置
+#   行頭の4スペース  : 1段のインデント (generator の indent に置き換える)
+#                      行頭の ${block} の直後の4スペースも同じ (block は改行で終わる複数行を差し込むもの)
+# テンプレートは indent ごとに初めて使うときに1度だけ解析し、リテラルと差し込み位置の列にしておく
+# 書き出しは SourceWriter のリストに足していき、最後に1度だけ join する
+
+PLACEHOLDER = re.compile(r'\$(?:(\w+)|\{(\w+)\})')
+INDENT_UNIT = '    '
+LEADING_INDENT = re.compile(r'(?:%s)+' % INDENT_UNIT)
+
+
+class CppTemplate:
+    def __init__(self, source:str):
+        self.source = source
+        # indent -> CompiledTemplate
+        self.compiled = dict()
+
+    def compile(self, indent:str):
+        compiled = self.compiled.get(indent)
+        if compiled == None:
+            compiled = CompiledTemplate.parse(self.source, indent)
+            self.compiled[indent] = compiled
+        return compiled
+
+    def render(self, indent:str, **values) -> str:
+        return self.compile(indent).render(values)
+
+
+# literals[0] names[0] literals[1] names[1] ... literals[-1] の順に並べたものが出力になる
+class CompiledTemplate:
+    __slots__ = ('literals', 'names')
+
+    def __init__(self, literals:list, names:list):
+        self.literals = literals
+        self.names = names
+
+    @classmethod
+    def parse(cls, source:str, indent:str):
+        literals = list()
+        names = list()
+        position = 0
+        # テンプレートの先頭も行頭
+        line_start = True
+        for match in PLACEHOLDER.finditer(source):
+            literals.append(CompiledTemplate.replace_indent(source[position:match.start()], indent, line_start))
+            names.append(match.group(1) or match.group(2))
+            line_start = match.start() == 0 or source[match.start() - 1] == '\n'
+            position = match.end()
+        literals.append(CompiledTemplate.replace_indent(source[position:], indent, line_start))
+        return cls(literals, names)
+
+    # line_start: literal がテンプレートの先頭か、行頭の ${block} の直後から始まる (先頭も行頭として扱う)
+    @staticmethod
+    def replace_indent(literal:str, indent:str, line_start:bool) -> str:
+        if indent == INDENT_UNIT:
+            return literal
+        lines = literal.split('\n')
+        for index, line in enumerate(lines):
+            if index == 0 and not line_start:
+                continue
+            match = LEADING_INDENT.match(line)
+            if match != None:
+                lines[index] = indent * (match.end() // len(INDENT_UNIT)) + line[match.end():]
+        return '\n'.join(lines)
+
+    # values にある名前だけを埋めたテンプレート (型ごとに決まる部分を先に埋めておく用)
+    def bind(self, values:dict):
+        literals = [self.literals[0]]
+        names = list()
+        for name, literal in zip(self.names, self.literals[1:]):
+            if name in values:
+                literals[-1] += str(values[name]) + literal
+            else:
+                names.append(name)
+                literals.append(literal)
+        return CompiledTemplate(literals, names)
+
+    def write_to(self, parts:list, values:dict):
+        append = parts.append
+        for literal, name in zip(self.literals, self.names):
+            append(literal)
+            append(str(values[name]))
+        append(self.literals[-1])
+
+    def render(self, values:dict) -> str:
+        parts = list()
+        self.write_to(parts, values)
+        return ''.join(parts)
+
+
+# 生成するファイル1つ分の書き出し先
+class SourceWriter:
+    def __init__(self, indent:str):
+        self.indent = indent
+        self.parts = list()
+
+    def write(self, text:str):
+        self.parts.append(text)
+
+    def render(self, template:CppTemplate, **values):
+        template.compile(self.indent).write_to(self.parts, values)
+
+    def getvalue(self) -> str:
+        return ''.join(self.parts)
@@ -1,8 +1,26 @@
 #!/usr/bin/python3
 #coding:utf-8
 
-import sys
-import toml
+import os
+import re
+import pickle
+import hashlib
+import argparse
+import tempfile
+from toml_cache import TomlCache
+from profiler import Profiler
+from repository_path import KanjiPath
+from bisect import bisect_right
+from logging import getLogger, basicConfig, INFO
+logger = getLogger(__name__)
+
+# numpy は読み込むだけで起動が遅くなるので、必要になったときに読み込む (無ければ None)
+def import_numpy():
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
 
 class IdInfo:
     def __init__(self, name:str, begin:int, end:int):
@@ -23,45 +41,365 @@ class IdInfo:
 
 class IdManager:
     ID_TOML = 'KANJI-asset/schema/master/id.toml'
+    # search_ids_by_int でこの件数以上ならnumpyでまとめて引く
+    NUMPY_THRESHOLD = 256
 
     def __init__(self):
-        self.dict_toml = self.load()
+        self.reload()
+
+    # id.toml を読み直して索引を作り直す
+    # 読み込み・索引作成に失敗したときは例外を投げ、それまでの索引をそのまま残す
+    def reload(self):
+        dict_toml = self.load()
+        with Profiler.span('IdManager.build_index', 'schema'):
+            self.build_index(dict_toml)
+        self.dict_toml = dict_toml
 
     def load(self):
-        return toml.load(open(IdManager.ID_TOML))
+        return TomlCache.load(IdManager.ID_TOML)
 
-    def search_id_by_int(self, id:int):
-        for value in self.dict_toml['id'].values():
-            if value['begin'] <= id and id <= value['end']:
-                return value['name']
+    # ロード時に一度だけ索引を作る
+    # infos: beginの昇順に並べたIdInfo / begins: その開始値 (bisect用) / dict_name: 名前 -> IdInfo
+    # scan_infos: 定義域が重なっているときだけ、id.toml に書かれた順のIdInfo (線形探索用)
+    # 索引はすべて作り終えてから入れ替える
+    def build_index(self, dict_toml:dict):
+        defined = [IdInfo.createFromToml(value) for value in dict_toml['id'].values()]
+        infos = sorted(defined, key=lambda info: (info.begin, info.end))
+        range_errors, overlapped = IdManager.check_ranges(infos)
+        for error in range_errors:
+            logger.error(error)
+        # 定義域が逆転しているIDは他のIDの検索を邪魔しないよう索引から外す
+        infos = [info for info in infos if info.begin <= info.end]
+        dict_name = dict()
+        for info in infos:
+            if info.name in dict_name:
+                logger.error('ID name is duplicated: %s' % info.name)
+                continue
+            dict_name[info.name] = info
+        self.infos = infos
+        self.range_errors = range_errors
+        self.begins = [info.begin for info in infos]
+        self.dict_name = dict_name
+        self.scan_infos = [info for info in defined if info.begin <= info.end] if overlapped else None
+        self.begins_array = None
+
+    # search_ids_by_int の numpy 版で使う配列
+    def build_arrays(self, numpy):
+        self.begins_array = numpy.array(self.begins, dtype=numpy.int64)
+        self.ends_array = numpy.array([info.end for info in self.infos], dtype=numpy.int64)
+        self.names_array = numpy.array([info.name for info in self.infos] + [None], dtype=object)
+
+    # 定義域が逆転しているID、他と重なっているIDを列挙し、(エラーのリスト, 重なりがあるか) を返す
+    @staticmethod
+    def check_ranges(infos:list) -> (list, bool):
+        errors = list()
+        overlapped = False
+        covering = None # これまでで最もendが大きいID
+        for info in infos:
+            if info.begin > info.end:
+                errors.append('ID range is inverted: %s (%d-%d)' % (info.name, info.begin, info.end))
+                continue
+            if covering is not None and info.begin <= covering.end:
+                errors.append('ID ranges overlap: %s (%d-%d) and %s (%d-%d)' % (
+                    covering.name, covering.begin, covering.end, info.name, info.begin, info.end))
+                overlapped = True
+            if covering is None or covering.end < info.end:
+                covering = info
+        return errors, overlapped
+
+    # 定義域が重なっていると、bisect では直前の定義域より前にある長い定義域を見落とすので線形に探す
+    # (そのときは id.toml で先に書かれたものを返す)
+    def search_info_by_int(self, id:int) -> IdInfo:
+        if self.scan_infos is not None:
+            return next((info for info in self.scan_infos if info.in_range(id)), None)
+        index = bisect_right(self.begins, id) - 1
+        if index >= 0 and self.infos[index].in_range(id):
+            return self.infos[index]
         return None
 
+    def search_id_by_int(self, id:int):
+        info = self.search_info_by_int(id)
+        return None if info is None else info.name
+
+    # 複数の数値をまとめて引く。見つからないものはNone
+    def search_ids_by_int(self, ids) -> list:
+        numpy = import_numpy() if len(ids) >= IdManager.NUMPY_THRESHOLD and self.scan_infos is None else None
+        if numpy is None:
+            return [self.search_id_by_int(id) for id in ids]
+        if self.begins_array is None:
+            self.build_arrays(numpy)
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        indices = numpy.searchsorted(self.begins_array, ids, side='right') - 1
+        found = indices >= 0
+        found[found] = ids[found] <= self.ends_array[indices[found]]
+        # 見つからなかったものは末尾の None を指す
+        indices[~found] = len(self.infos)
+        return self.names_array[indices].tolist()
+
     def search_id_by_name(self, name:str) -> IdInfo:
-        for value in self.dict_toml['id'].values():
-            if value['name'] == name:
-                return IdInfo.createFromToml(value)
-        return None
+        return self.dict_name.get(name)
 
-def search_id_by_int(id:int):
-    id_mgr = IdManager()
+    # 定義域の内容から求めるハッシュ (定義域に依存するキャッシュの確認用)
+    def content_hash(self) -> str:
+        source = ''.join('%s:%d:%d\n' % (info.name, info.begin, info.end) for info in self.infos)
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+# 1つのIDの定義域のうち、実データの主キーとして使われている値を1bitずつで持つ
+class IdBitmap:
+    FULL_BYTE = re.compile(b'[^\xff]')
+
+    def __init__(self, info:IdInfo):
+        self.info = info
+        self.size = info.end - info.begin + 1
+        self.bits = bytearray((self.size + 7) // 8)
+        self.used_count = 0
+        self.duplicates = dict() # 2回以上使われている値 -> 余分な回数 (消すときに bit を落とさないため)
+        self.hint = 0 # これより前のバイトはすべて使用済み
+
+    def is_used(self, id:int) -> bool:
+        offset = id - self.info.begin
+        return bool(self.bits[offset >> 3] & (1 << (offset & 7)))
+
+    def add(self, id:int):
+        offset = id - self.info.begin
+        if self.is_used(id):
+            self.duplicates[id] = self.duplicates.get(id, 0) + 1
+            return
+        self.bits[offset >> 3] |= 1 << (offset & 7)
+        self.used_count += 1
+
+    def remove(self, id:int):
+        if id in self.duplicates:
+            self.duplicates[id] -= 1
+            if self.duplicates[id] == 0:
+                del self.duplicates[id]
+            return
+        if not self.is_used(id):
+            return
+        offset = id - self.info.begin
+        self.bits[offset >> 3] &= ~(1 << (offset & 7)) & 0xff
+        self.used_count -= 1
+        self.hint = min(self.hint, offset >> 3)
+
+    # 空いている値を小さい順に count 個 (足りなければあるだけ)
+    # 使用済みのバイト (0xff) は正規表現でまとめて読み飛ばす
+    def next_free(self, count:int=1) -> list:
+        free = list()
+        position = self.hint
+        while len(free) < count:
+            match = IdBitmap.FULL_BYTE.search(self.bits, position)
+            if match == None:
+                break
+            position = match.start()
+            if len(free) == 0:
+                self.hint = position
+            byte = self.bits[position]
+            for bit in range(8):
+                offset = (position << 3) + bit
+                if offset >= self.size or len(free) == count:
+                    break
+                if not byte & (1 << bit):
+                    free.append(self.info.begin + offset)
+            position += 1
+        return free
+
+    @property
+    def fill_ratio(self) -> float:
+        return self.used_count / self.size
+
+
+# 実データ (class/**/*.toml) の主キーとして使われているIDを定義域ごとの IdBitmap にまとめ、空いているIDを探す
+# 結果はファイルごとの使用IDと一緒に .toml_cache にキャッシュし、次回は変わったファイルの分だけ更新する
+# id.toml の定義域が変わったらキャッシュは捨てて作り直す
+class IdAllocator:
+    CACHE_PATH = TomlCache.DIRECTORY / 'id_allocation.pickle'
+    VERSION = 1
+
+    def __init__(self, id_mgr:IdManager, type_mgr=None):
+        self.id_mgr = id_mgr
+        self.type_mgr = type_mgr
+        self.root_path = KanjiPath.absolute('md_class')
+        self.load_cache()
+        self.update()
+
+    def load_cache(self):
+        self.id_hash = self.id_mgr.content_hash()
+        self.files = dict() # class/ からの相対パス -> { 'stat': (mtime_ns, size), 'type_hash': .., 'ids': (ID名, [値, ...]) or None }
+        self.bitmaps = {info.name: IdBitmap(info) for info in self.id_mgr.infos}
+        try:
+            with open(IdAllocator.CACHE_PATH, 'rb') as f:
+                cache = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning('broken id allocation cache is ignored: %s' % e)
+            return
+        if cache.get('version') == IdAllocator.VERSION and cache.get('id_hash') == self.id_hash:
+            self.files = cache['files']
+            for name, (bits, used_count, duplicates) in cache['bitmaps'].items():
+                bitmap = self.bitmaps[name]
+                bitmap.bits, bitmap.used_count, bitmap.duplicates = bits, used_count, duplicates
+
+    def save_cache(self):
+        os.makedirs(IdAllocator.CACHE_PATH.parent, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=IdAllocator.CACHE_PATH.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bitmaps = {name: (bitmap.bits, bitmap.used_count, bitmap.duplicates) for name, bitmap in self.bitmaps.items()}
+                pickle.dump({'version': IdAllocator.VERSION, 'id_hash': self.id_hash, 'files': self.files, 'bitmaps': bitmaps}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, IdAllocator.CACHE_PATH)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    # 変わったファイルだけ読み直して bitmap を更新する
+    def update(self):
+        with Profiler.span('IdAllocator.update', 'schema'):
+            changed = self.update_impl()
+        if changed:
+            self.save_cache()
+
+    def update_impl(self) -> bool:
+        if self.type_mgr == None:
+            from master_type import MDTypeManager
+            self.type_mgr = MDTypeManager()
+        changed = False
+        paths = set()
+        for toml_path in sorted(self.root_path.glob('**/*.toml')):
+            path = str(toml_path.relative_to(self.root_path))
+            paths.add(path)
+            stat = toml_path.stat()
+            type_info = self.find_type_info(toml_path)
+            type_hash = None if type_info == None else type_info.content_hash()
+            entry = self.files.get(path)
+            if entry != None and entry['stat'] == (stat.st_mtime_ns, stat.st_size) and entry['type_hash'] == type_hash:
+                continue
+            logger.debug('scan used IDs: %s' % path)
+            self.apply(entry, -1)
+            entry = {'stat': (stat.st_mtime_ns, stat.st_size), 'type_hash': type_hash, 'ids': self.read_ids(toml_path, type_info)}
+            self.apply(entry, +1)
+            self.files[path] = entry
+            changed = True
+        for path in set(self.files) - paths:
+            self.apply(self.files.pop(path), -1)
+            changed = True
+        return changed
+
+    def find_type_info(self, toml_path):
+        directory = str(toml_path.parent.relative_to(self.root_path))
+        key = self.type_mgr.ROOT if directory == '.' else directory
+        return self.type_mgr.dict_info.get(key, dict()).get(toml_path.stem)
+
+    # 主キーがIDの型なら (ID名, 主キーの値の列)。定義域外・int でない値は無視する
+    def read_ids(self, toml_path, type_info) -> tuple:
+        if type_info == None:
+            return None
+        field = type_info.fields.get(type_info.primary_key)
+        if field == None or not field.is_id or not field.type_name in self.bitmaps:
+            return None
+        try:
+            data = TomlCache.load(toml_path)['masterdata']
+        except Exception as e:
+            logger.warning('failed to load %s: %s' % (toml_path, e))
+            return None
+        info = self.bitmaps[field.type_name].info
+        values = [record.get(field.name) for record in data.values()]
+        return (field.type_name, [value for value in values if type(value) is int and info.in_range(value)])
+
+    def apply(self, entry:dict, sign:int):
+        if entry == None or entry['ids'] == None:
+            return
+        id_name, values = entry['ids']
+        bitmap = self.bitmaps[id_name]
+        for value in values:
+            if sign > 0:
+                bitmap.add(value)
+            else:
+                bitmap.remove(value)
+
+    def next_free(self, name:str, count:int=1) -> list:
+        return self.bitmaps[name].next_free(count)
+
+    # どの定義域にも入らない値は None
+    def is_free(self, id:int) -> bool:
+        info = self.id_mgr.search_info_by_int(id)
+        if info == None:
+            return None
+        return not self.bitmaps[info.name].is_used(id)
+
+    # [(ID名, 使用数, 定義域の大きさ, 使用率), ...]
+    def fill_ratios(self) -> list:
+        return [(name, bitmap.used_count, bitmap.size, bitmap.fill_ratio) for name, bitmap in self.bitmaps.items()]
+
+def search_id_by_int(id_mgr:IdManager, id:int):
     result = id_mgr.search_id_by_int(id)
     if result == None:
         print('Not Found %d' % id)
     else:
         print('%d is within %s' % (id, result))
 
-def search_id_by_name(name:str):
-    id_mgr = IdManager()
+def search_id_by_name(id_mgr:IdManager, name:str):
     result = id_mgr.search_id_by_name(name)
     if result == None:
         print('Not Found %s' % name)
     else:
         print('%sID is exist (range:%d-%d)' % (name, result.begin, result.end))
 
-if __name__ == "__main__":
-    args = sys.argv
-    if args[1].isdigit():
-        search_id_by_int(int(args[1]))
+def next_free_ids(allocator:IdAllocator, name:str, count:int):
+    if allocator.id_mgr.search_id_by_name(name) == None:
+        print('Not Found %s' % name)
+        return
+    free = allocator.next_free(name, count)
+    print('free %sID: %s' % (name, ' '.join(map(str, free))))
+    if len(free) < count:
+        print('%sID has only %d free IDs' % (name, len(free)))
+
+def is_free_id(allocator:IdAllocator, id:int):
+    free = allocator.is_free(id)
+    if free == None:
+        print('Not Found %d' % id)
     else:
-        search_id_by_name(args[1])
+        print('%d is %s' % (id, 'free' if free else 'used'))
+
+def print_fill_ratios(allocator:IdAllocator):
+    for name, used, size, ratio in allocator.fill_ratios():
+        print('%-16s %8d / %-8d %6.1f%%' % (name, used, size, ratio * 100))
 
+# 空きIDを調べるオプション (kanji.py id と共通)
+def add_allocation_arguments(parser):
+    parser.add_argument('--free', action='append', default=list(), metavar='NAME',
+        help='ID名の定義域で、実データの主キーに使われていないIDを小さい順に --count 個表示する')
+    parser.add_argument('--count', type=int, default=1,
+        help='--free で表示する数')
+    parser.add_argument('--is-free', action='append', type=int, default=list(), metavar='ID',
+        help='数値が実データの主キーに使われていないか')
+    parser.add_argument('--fill', action='store_true',
+        help='定義域ごとの使用率を表示する')
+
+def uses_allocator(args) -> bool:
+    return len(args.free) != 0 or len(args.is_free) != 0 or args.fill
+
+def run_allocation(allocator:IdAllocator, args):
+    for name in args.free:
+        next_free_ids(allocator, name, args.count)
+    for id in args.is_free:
+        is_free_id(allocator, id)
+    if args.fill:
+        print_fill_ratios(allocator)
+
+if __name__ == "__main__":
+    basicConfig(level=INFO)
+    parser = argparse.ArgumentParser(description='数値が属するID、IDの定義域、空いているIDを調べる')
+    parser.add_argument('values', nargs='*',
+        help='数値またはID名')
+    add_allocation_arguments(parser)
+    args = parser.parse_args()
+    id_mgr = IdManager()
+    for arg in args.values:
+        if arg.isdigit():
+            search_id_by_int(id_mgr, int(arg))
+        else:
+            search_id_by_name(id_mgr, arg)
+    if uses_allocator(args):
+        run_allocation(IdAllocator(id_mgr), args)
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+#coding:utf-8
+
+import sys
+import argparse
+from logging import getLogger, basicConfig, DEBUG, INFO, WARNING
+logger = getLogger(__name__)
+
+# 各ツールをまとめて呼び出すコマンド
+# サブコマンドは '+' で繋ぐと1回の起動で順に実行し、読み込んだ型情報・ID情報を共有する
+# 失敗したサブコマンドがあればそこで止めて終了コード 1 を返す
+#
+#   python kanji.py validate --jobs 4 + build incremental
+#   python kanji.py id 1500 Kanji
+#
+# 各ツールのモジュールは使うサブコマンドの中で import する (起動を速くするため)
+
+CHAIN_SEPARATOR = '+'
+
+
+# サブコマンド間で共有する読み込み済みの情報 (使われたときに初めて読み込む)
+class Context:
+    def __init__(self, verbose:bool):
+        self.verbose = verbose
+        self._type_mgr = None
+        self._id_mgr = None
+        self._validator = None
+
+    @property
+    def type_mgr(self):
+        if self._type_mgr == None:
+            from master_type import MDTypeManager
+            self._type_mgr = MDTypeManager(self.verbose)
+        return self._type_mgr
+
+    @property
+    def id_mgr(self):
+        if self._id_mgr == None:
+            from id_manage import IdManager
+            self._id_mgr = IdManager()
+        return self._id_mgr
+
+    @property
+    def validator(self):
+        if self._validator == None:
+            from validate_data import MDValidator
+            self._validator = MDValidator(self.type_mgr, self.id_mgr)
+        return self._validator
+
+
+def jobs_count(jobs:int) -> int:
+    import os
+    return jobs if jobs > 0 else os.cpu_count()
+
+def run_build(context:Context, args) -> bool:
+    import build_schema
+    from repository_path import KanjiPath
+    build_schema.IS_DEBUG = args.mode == 'debug'
+    build_schema.IS_DRY_RUN = args.dry_run
+    # id.toml は dense のときだけ必要なので、それ以外では読み込まない
+    id_mgr = context.id_mgr if args.layout == 'dense' else None
+    options = build_schema.make_options(args.repository, args.layout, id_mgr, args.compact)
+    dest_dir = KanjiPath.absolute('md_header')
+    if args.mode == 'incremental':
+        return build_schema.create_cpp_sources_incremental(context.type_mgr, dest_dir, jobs_count(args.jobs), options)
+    return build_schema.create_cpp_sources(context.type_mgr, dest_dir, jobs_count(args.jobs), clean=True, options=options)
+
+def run_validate(context:Context, args) -> bool:
+    import json
+    from validate_data import MDValidator
+    context.validator.streaming = args.stream
+    context.validator.max_errors = args.max_errors
+    if args.incremental:
+        from record_store import RecordStore
+        store = RecordStore.load(context.id_mgr)
+        report = context.validator.validate_incremental(store, jobs_count(args.jobs))
+        store.save()
+    else:
+        report = context.validator.validate(jobs_count(args.jobs))
+    if args.report != None:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    print(MDValidator.summary(report))
+    return report['error_count'] == 0
+
+def run_id(context:Context, args) -> bool:
+    import id_manage
+    for value in args.values:
+        if value.isdigit():
+            id_manage.search_id_by_int(context.id_mgr, int(value))
+        else:
+            id_manage.search_id_by_name(context.id_mgr, value)
+    if id_manage.uses_allocator(args):
+        id_manage.run_allocation(id_manage.IdAllocator(context.id_mgr, context.type_mgr), args)
+    return True
+
+def make_parser() -> argparse.ArgumentParser:
+    from pathlib import Path
+    parser = argparse.ArgumentParser(
+        description='KANJI のマスターデータ用ツール。サブコマンドは "%s" で繋いで続けて実行できる' % CHAIN_SEPARATOR)
+    parser.add_argument('--path-toml', type=Path, default=Path('path.toml'),
+        help='パス定義ファイル')
+    parser.add_argument('--no-cache', action='store_true',
+        help='パース済みtomlのキャッシュを使わない')
+    parser.add_argument('--profile', action='store_true',
+        help='処理ごとの時間を計測し、Chrome trace形式で書き出す')
+    parser.add_argument('--profile-output', default='profile.json', metavar='TRACE_JSON',
+        help='--profile の書き出し先 (既定: profile.json)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help='詳細なログと読み込んだ型情報を表示する')
+    parser.add_argument('-q', '--quiet', action='store_true',
+        help='警告以上のログだけを表示する')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help='masterdata.toml から hpp/cpp を生成する')
+    build.add_argument('mode', nargs='?', choices=('debug', 'incremental'),
+        help='debug: 書き込まずに出力内容をprintする / incremental: 型定義が変わった型だけを生成し直す')
+    build.add_argument('-j', '--jobs', type=int, default=1,
+        help='生成の並列数 (0ならCPUコア数)')
+    build.add_argument('--dry-run', action='store_true',
+        help='書き込まずに、出力先との差分 (追加・変更・削除されるファイル) の一覧を表示する')
+    # build_schema.add_option_arguments と同じもの (起動を速くするためここでは build_schema を import しない)
+    build.add_argument('--repository', choices=('toml', 'binary'), default='toml',
+        help='Repositoryの読み込み元 (binary は md_binary.py で書き出した .mdb を読む)')
+    build.add_argument('--layout', choices=('map', 'dense', 'columns'), default='map',
+        help='Repositoryのデータ構造 (dense は ID - begin を添字にした配列、columns は field ごとの配列)')
+    build.add_argument('--compact', action='store_true',
+        help='Masterのメンバを詰めて並べ、stringを共通の文字列プールに持たせる')
+    build.set_defaults(run=run_build)
+
+    validate = subparsers.add_parser('validate', help='実データが型定義に適合しているかを確認する')
+    validate.add_argument('-j', '--jobs', type=int, default=1,
+        help='検証の並列数 (0ならCPUコア数)')
+    validate.add_argument('--report', type=Path,
+        help='検証結果をJSONで書き出すパス')
+    validate.add_argument('--stream', action='store_true',
+        help='ファイル全体を読み込まず、レコードごとにパースして検証する (巨大なファイル向け)')
+    validate.add_argument('--max-errors', type=int,
+        help='エラーがこの数に達したら検証を打ち切る')
+    validate.add_argument('--incremental', action='store_true',
+        help='前回から追加・変更されたレコードだけを検証する (変わっていないレコードは前回の結果を使う)')
+    validate.set_defaults(run=run_validate)
+
+    id = subparsers.add_parser('id', help='数値が属するID、またはIDの定義域を調べる')
+    id.add_argument('values', nargs='*',
+        help='数値またはID名')
+    # id_manage.add_allocation_arguments と同じもの
+    id.add_argument('--free', action='append', default=list(), metavar='NAME',
+        help='ID名の定義域で、実データの主キーに使われていないIDを小さい順に --count 個表示する')
+    id.add_argument('--count', type=int, default=1,
+        help='--free で表示する数')
+    id.add_argument('--is-free', action='append', type=int, default=list(), metavar='ID',
+        help='数値が実データの主キーに使われていないか')
+    id.add_argument('--fill', action='store_true',
+        help='定義域ごとの使用率を表示する')
+    id.set_defaults(run=run_id)
+    return parser
+
+# argv を '+' で区切り、先頭には全体のオプションも含めて解釈する
+def parse_chain(parser:argparse.ArgumentParser, argv:list) -> list:
+    chain = [list()]
+    for arg in argv:
+        if arg == CHAIN_SEPARATOR:
+            chain.append(list())
+        else:
+            chain[-1].append(arg)
+    first = parser.parse_args(chain[0])
+    commands = [first]
+    # 2つ目以降は全体のオプションを先頭のものに揃える
+    global_options = chain[0][:chain[0].index(first.command)]
+    for command_argv in chain[1:]:
+        commands.append(parser.parse_args(global_options + command_argv))
+    return commands
+
+def main(argv:list) -> int:
+    parser = make_parser()
+    commands = parse_chain(parser, argv)
+    first = commands[0]
+    basicConfig(level=DEBUG if first.verbose else WARNING if first.quiet else INFO)
+    if first.no_cache:
+        from toml_cache import TomlCache
+        TomlCache.set_enabled(False)
+    from profiler import Profiler
+    if first.profile:
+        Profiler.enable()
+    from repository_path import KanjiPath
+    KanjiPath.load(first.path_toml)
+
+    context = Context(first.verbose)
+    succeeded = True
+    for args in commands:
+        with Profiler.span(args.command, 'command'):
+            succeeded = args.run(context, args)
+        if not succeeded:
+            logger.error('%s failed' % args.command)
+            break
+    Profiler.report(first.profile_output)
+    return 0 if succeeded else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
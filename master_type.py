@@ -1,7 +1,9 @@
 #!/usr/bin/python3
 #coding:utf-8
 
-import toml
+from toml_cache import TomlCache
+from profiler import Profiler
+import hashlib
 from repository_path import KanjiPath
 from logging import getLogger, basicConfig, DEBUG
 logger = getLogger(__name__)
@@ -52,6 +54,8 @@ class MDTypeInfo:
 
     def __init__(self, toml:dict):
         self.data_type_name = toml['data_type_name']
+        # true なら MasterDataLoader::preloadAll で読み込まず、初めて使われたときに読み込む
+        self.lazy = toml.get('lazy', False)
         self.primary_key = None
         self.types_requires_include = list()
         self.fields = self.read_fields(toml['field'])
@@ -77,6 +81,14 @@ class MDTypeInfo:
             include_files.append(MDTypeInfo.INCLUDE[type_name])
         return include_files
 
+    # 型定義の内容から求めるハッシュ
+    # 生成物が変化しうる要素 (型名、fieldの宣言順・型・属性) だけを含める
+    def content_hash(self) -> str:
+        source = self.data_type_name + '\n'
+        for field in self.fields.values():
+            source += '%s:%s:%d:%d\n' % (field.name, field.type_name, field.is_id, field.is_primary_key)
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
     def log(self):
         print('// %s --------------------' % self.data_type_name)
         for field in self.fields.values():
@@ -94,30 +106,38 @@ class MDTypeInfo:
 # masterdata.toml全体を読み込み型情報に変換する
 class MDTypeManager:
     ROOT = 'root'
-    def __init__(self):
-        self.dict_toml = None
-        self.dict_info = dict()
-        self.dict_info[MDTypeManager.ROOT] = dict()
-        self.load()
-        self.read(self.dict_toml['masterdata'], '')
-        pprint.pprint(self.dict_info)
+    # verbose: 読み込んだ型情報を表示する
+    def __init__(self, verbose:bool=False):
+        self.reload()
+        if verbose:
+            pprint.pprint(self.dict_info)
+
+    # masterdata.toml を読み直して型情報を作り直す
+    # 読み込み・変換に失敗したときは例外を投げ、それまでの型情報をそのまま残す
+    def reload(self):
+        dict_toml = self.load()
+        dict_info = dict()
+        dict_info[MDTypeManager.ROOT] = dict()
+        with Profiler.span('MDTypeManager.read', 'schema'):
+            self.read(dict_toml['masterdata'], '', dict_info)
+        self.dict_toml = dict_toml
+        self.dict_info = dict_info
 
     def load(self):
-        with open(KanjiPath.absolute('md_toml')) as f:
-            self.dict_toml = toml.load(f)
+        return TomlCache.load(KanjiPath.absolute('md_toml'))
 
-    def read(self, dict_toml:dict, parent_keys:str):
+    def read(self, dict_toml:dict, parent_keys:str, dict_info:dict):
         for key in dict_toml:
             if key.startswith('md_'):
                 md = MDTypeInfo(dict_toml[key])
                 if len(parent_keys) == 0:
-                    self.dict_info[MDTypeManager.ROOT][md.data_type_name] = md
+                    dict_info[MDTypeManager.ROOT][md.data_type_name] = md
                 else:
-                    self.dict_info[parent_keys][md.data_type_name] = md
+                    dict_info[parent_keys][md.data_type_name] = md
             else:
                 fullkey = self.fullkey(key, parent_keys)
-                self.dict_info[fullkey] = dict()
-                self.read(dict_toml[key], fullkey)
+                dict_info[fullkey] = dict()
+                self.read(dict_toml[key], fullkey, dict_info)
 
     def fullkey(self, key:str, parent_keys:str):
         if len(parent_keys) == 0:
@@ -131,5 +151,5 @@ class MDTypeManager:
 
 if __name__ == "__main__":
     basicConfig(level=DEBUG)
-    mgr = MDTypeManager()
+    mgr = MDTypeManager(verbose=True)
 
@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+#coding:utf-8
+
+from pathlib import Path
+import sys
+import os
+import struct
+import argparse
+from repository_path import KanjiPath
+from master_type import MDTypeInfo, MDField
+from validate_data import MDValidator
+from logging import getLogger, basicConfig, DEBUG, INFO
+logger = getLogger(__name__)
+
+# 検証済みの class/*.toml を型ごとのバイナリ (.mdb) に変換する
+# クライアントは RepositoryBinaryCppGenerator が生成したコードでこれを読み込む
+#
+# ファイル構成 (すべてリトルエンディアン)
+#   header      : MDBinaryLayout.HEADER
+#   records     : record_size バイト固定長のレコードを主キー昇順に record_count 個
+#   string pool : UTF-8 文字列を重複なしで連結したもの
+#   id table    : (主キー int32, レコードのファイル先頭からのオフセット uint32) を主キー昇順に record_count 個
+#                 主キーが int / ID の型だけ。それ以外の型は id_table_offset が 0
+# 生成される読み込みコードは id table があればそれをたどってレコードを引く
+
+
+# 1つの型のレコードをどう並べるか
+# fields は (MDField, レコード先頭からのオフセット, struct書式) を宣言順に持つ
+class MDBinaryLayout:
+    MAGIC = b'KJMD'
+    # 2 は id table の無い形式だった
+    VERSION = 3
+    HEADER_FIELDS = (
+        ('magic', '4s'),
+        ('version', 'I'),
+        ('schema_hash', 'I'),
+        ('record_count', 'I'),
+        ('record_size', 'I'),
+        ('records_offset', 'I'),
+        ('string_pool_offset', 'I'),
+        ('string_pool_size', 'I'),
+        ('id_table_offset', 'I'))
+    HEADER = struct.Struct('<' + ''.join(format for _, format in HEADER_FIELDS))
+    ID_ENTRY = struct.Struct('<iI')
+    # string は string pool 内の (オフセット, バイト長)、Vec2 は (x, y)
+    FIELD_FORMATS = {'int': 'i', 'float': 'f', 'double': 'd', 'string': 'II', 'Vec2': 'dd'}
+    ID_FORMAT = 'i'
+
+    def __init__(self, type_info:MDTypeInfo):
+        self.type_info = type_info
+        self.fields = list()
+        offset = 0
+        for field in type_info.fields.values():
+            format = MDBinaryLayout.field_format(field)
+            self.fields.append((field, offset, format))
+            offset += struct.calcsize('<' + format)
+        self.record = struct.Struct('<' + ''.join(format for _, _, format in self.fields))
+        # 生成したコードと読み込むバイナリの型定義が一致しているか確かめるための値
+        self.schema_hash = int(type_info.content_hash()[:8], 16)
+
+    # header内の各値のファイル先頭からのオフセット
+    @classmethod
+    def header_offset(cls, name:str) -> int:
+        offset = 0
+        for field_name, format in MDBinaryLayout.HEADER_FIELDS:
+            if field_name == name:
+                return offset
+            offset += struct.calcsize('<' + format)
+        raise KeyError(name)
+
+    @classmethod
+    def field_format(cls, field:MDField) -> str:
+        if field.is_id:
+            return MDBinaryLayout.ID_FORMAT
+        return MDBinaryLayout.FIELD_FORMATS[field.type_name]
+
+    # fieldのレコード先頭からのオフセットとstruct書式
+    def field_offset(self, name:str) -> (int, str):
+        for field, offset, format in self.fields:
+            if field.name == name:
+                return offset, format
+        raise KeyError(name)
+
+    @property
+    def record_size(self) -> int:
+        return self.record.size
+
+    # 主キーが int32 で書かれる型だけ id table を持つ
+    @property
+    def has_id_table(self) -> bool:
+        _, format = self.field_offset(self.type_info.primary_key)
+        return format == MDBinaryLayout.ID_FORMAT
+
+
+class MDBinaryExporter:
+    def __init__(self, layout:MDBinaryLayout):
+        self.layout = layout
+        self.string_pool = bytearray()
+        self.string_offsets = dict()
+
+    # data = toml の [masterdata] 以下 (検証済みであること)
+    def export(self, data:dict) -> bytes:
+        primary_key = self.layout.type_info.primary_key
+        records = sorted(data.values(), key=lambda record: record[primary_key])
+        packed_records = b''.join(self.pack(record) for record in records)
+        header_size = MDBinaryLayout.HEADER.size
+        records_offset = header_size
+        string_pool_offset = records_offset + len(packed_records)
+        if self.layout.has_id_table:
+            id_table_offset = string_pool_offset + len(self.string_pool)
+            id_table = b''.join(
+                MDBinaryLayout.ID_ENTRY.pack(record[primary_key], records_offset + index * self.layout.record_size)
+                for index, record in enumerate(records))
+        else:
+            id_table_offset = 0
+            id_table = b''
+        header = MDBinaryLayout.HEADER.pack(
+            MDBinaryLayout.MAGIC,
+            MDBinaryLayout.VERSION,
+            self.layout.schema_hash,
+            len(records),
+            self.layout.record_size,
+            records_offset,
+            string_pool_offset,
+            len(self.string_pool),
+            id_table_offset)
+        return header + packed_records + bytes(self.string_pool) + id_table
+
+    def pack(self, record:dict) -> bytes:
+        values = list()
+        for field, _, _ in self.layout.fields:
+            value = record[field.name]
+            if field.is_id:
+                values.append(value)
+            elif field.type_name == 'string':
+                values.extend(self.intern(value))
+            elif field.type_name == 'Vec2':
+                values.extend((value['x'], value['y']) if isinstance(value, dict) else value)
+            else:
+                values.append(value)
+        return self.layout.record.pack(*values)
+
+    # 同じ文字列は string pool に1度だけ置く
+    def intern(self, text:str) -> tuple:
+        if not text in self.string_offsets:
+            encoded = text.encode('utf-8')
+            self.string_offsets[text] = (len(self.string_pool), len(encoded))
+            self.string_pool += encoded
+        return self.string_offsets[text]
+
+
+# 全class/*.tomlを検証し、エラーがなければ md_binary 以下に同じ構成で .mdb を書き出す
+def export_all(jobs:int=1) -> bool:
+    validator = MDValidator()
+    report = validator.validate(jobs)
+    if report['error_count'] != 0:
+        print(MDValidator.summary(report))
+        logger.error('binary export is aborted because validation failed')
+        return False
+    for result in report['files']:
+        export_file(validator, result)
+    return True
+
+# 検証済みの1ファイル分 (MDValidator.validate_toml の結果) を書き出す
+def export_file(validator:MDValidator, result:dict):
+    dest_dir = KanjiPath.absolute('md_binary')
+    toml_path = Path(result['path'])
+    sub_directories = toml_path.parent.parts or ('.',)
+    type_info = validator.find_type_info(sub_directories, result['type'])
+    data = validator.load(sub_directories, toml_path.name)
+    blob = MDBinaryExporter(MDBinaryLayout(type_info)).export(data)
+    file_path = dest_dir / toml_path.with_suffix('.mdb')
+    os.makedirs(file_path.parent, exist_ok=True)
+    with open(file_path, 'wb') as f:
+        f.write(blob)
+    logger.info('export: %s (%d records, %d bytes)' % (file_path.relative_to(dest_dir), result['records'], len(blob)))
+
+
+if __name__ == "__main__":
+    basicConfig(level=INFO)
+    parser = argparse.ArgumentParser(description='検証済みのマスターデータをバイナリに変換する')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='検証の並列数 (0ならCPUコア数)')
+    args = parser.parse_args()
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    sys.exit(0 if export_all(jobs) else 1)
@@ -0,0 +1,254 @@
+#!/usr/bin/python3
+#coding:utf-8
+
+import array
+import argparse
+from repository_path import KanjiPath
+from master_type import MDTypeManager, MDTypeInfo, MDField
+from toml_cache import TomlCache
+from toml_stream import iterate_sections, parse_section, UnsplittableToml
+from id_manage import import_numpy
+from logging import getLogger, basicConfig, INFO
+logger = getLogger(__name__)
+numpy = import_numpy()
+
+# 1つの型の実データを field ごとの列 (numpy 配列) で持ち、調整・QA用のスクリプトから集計できるようにする
+#   table = MDTable.load(MDTypeManager(), 'kanji/KanjiParam')
+#   strong = table.filter(table['power'] >= 10)
+#   strong.aggregate('power', 'mean', by='owner')
+# 列の型は生成される C++ の型に合わせる
+#   int / ID : int32, float : float32, double : float64
+#   string   : MDStringPool の添字 (uint32)。同じ文字列は全テーブルで1つだけ持つ
+#   Vec2     : (レコード数, 2) の float64 (x, y)
+# 実データは検証済みであること (validate_data.py)
+
+
+# 文字列を重複なしで持ち、添字で引けるようにする
+class MDStringPool:
+    def __init__(self):
+        self.strings = list()
+        self.indices = dict()
+
+    def intern(self, text:str) -> int:
+        index = self.indices.get(text)
+        if index == None:
+            index = len(self.strings)
+            self.indices[text] = index
+            self.strings.append(text)
+        return index
+
+    # 無い文字列は -1
+    def find(self, text:str) -> int:
+        return self.indices.get(text, -1)
+
+    def __getitem__(self, index:int) -> str:
+        return self.strings[index]
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+    def decode(self, indices) -> list:
+        return [self.strings[index] for index in indices.tolist()]
+
+
+class MDTable:
+    DTYPES = {'int': 'int32', 'float': 'float32', 'double': 'float64', 'string': 'uint32', 'Vec2': 'float64'}
+    ID_DTYPE = 'int32'
+    # 列を作る間に値を溜める array.array の型
+    ARRAY_CODES = {'int32': 'i', 'float32': 'f', 'float64': 'd', 'uint32': 'I'}
+    AGGREGATES = ('count', 'sum', 'mean', 'min', 'max')
+
+    # keys: レコードの key (pool の添字)、columns: field名 -> 列
+    def __init__(self, type_info:MDTypeInfo, fields:dict, keys, columns:dict, pool:MDStringPool):
+        if numpy is None:
+            raise ImportError('MDTable requires numpy')
+        self.type_info = type_info
+        self.fields = fields
+        self.keys = keys
+        self.columns = columns
+        self.pool = pool
+        self._primary_index = None
+
+    # type_path: class/ からの相対パス (拡張子なし) e.g. 'kanji/KanjiParam'
+    # ファイル全体の dict は作らず、レコードごとにパースしては列に足していく
+    # レコードごとに区切れない書き方のファイルは、validate_data.py --stream と同じくファイル全体を読み込む
+    @classmethod
+    def load(cls, type_mgr:MDTypeManager, type_path:str, pool:MDStringPool=None):
+        *directories, type_name = type_path.split('/')
+        key = '/'.join(directories) if len(directories) != 0 else MDTypeManager.ROOT
+        type_info = type_mgr.at(type_name, key)
+        toml_path = KanjiPath.absolute('md_class').joinpath(*directories) / (type_name + '.toml')
+        logger.debug('load ' + str(toml_path))
+        # 後ろの下位テーブルで区切れないと分かることがあるので、先に全体を区切ってからパースする
+        try:
+            sections = [text for _, text in iterate_sections(toml_path)]
+        except UnsplittableToml as e:
+            logger.warning('%s, loading the whole file' % e)
+            return cls.from_records(type_info, TomlCache.load(toml_path)['masterdata'].items(), pool)
+        records = (item for text in sections for item in parse_section(text).items())
+        return cls.from_records(type_info, records, pool)
+
+    # records: (key, record) を順に返すもの (toml の [masterdata] 以下の items() など)
+    @classmethod
+    def from_records(cls, type_info:MDTypeInfo, records, pool:MDStringPool=None):
+        if numpy is None:
+            raise ImportError('MDTable requires numpy')
+        pool = pool if pool != None else MDStringPool()
+        keys = array.array('I')
+        buffers = {name: array.array(MDTable.ARRAY_CODES[MDTable.dtype(field)]) for name, field in type_info.fields.items()}
+        for key, record in records:
+            keys.append(pool.intern(key))
+            for name, field in type_info.fields.items():
+                value = record[name]
+                if field.is_id:
+                    buffers[name].append(value)
+                elif field.type_name == 'string':
+                    buffers[name].append(pool.intern(value))
+                elif field.type_name == 'Vec2':
+                    buffers[name].extend((value['x'], value['y']) if isinstance(value, dict) else value)
+                else:
+                    buffers[name].append(value)
+        columns = dict()
+        for name, field in type_info.fields.items():
+            column = numpy.frombuffer(buffers[name], dtype=MDTable.dtype(field)).copy()
+            columns[name] = column.reshape(-1, 2) if field.type_name == 'Vec2' and not field.is_id else column
+        return cls(type_info, dict(type_info.fields), numpy.frombuffer(keys, dtype='uint32').copy(), columns, pool)
+
+    @staticmethod
+    def dtype(field:MDField) -> str:
+        return MDTable.ID_DTYPE if field.is_id else MDTable.DTYPES[field.type_name]
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    # 列そのもの (string は pool の添字のまま)。比較して filter に渡す用
+    def __getitem__(self, name:str):
+        return self.columns[name]
+
+    # 列の値 (string は文字列のリストに戻す)
+    def values(self, name:str):
+        if self.is_string(name):
+            return self.pool.decode(self.columns[name])
+        return self.columns[name]
+
+    def is_string(self, name:str) -> bool:
+        field = self.fields[name]
+        return field.type_name == 'string' and not field.is_id
+
+    def key(self, row:int) -> str:
+        return self.pool[int(self.keys[row])]
+
+    # 1レコードを toml と同じ形の dict で返す
+    def row(self, row:int) -> dict:
+        record = dict()
+        for name, field in self.fields.items():
+            value = self.columns[name][row]
+            if self.is_string(name):
+                record[name] = self.pool[int(value)]
+            else:
+                record[name] = value.tolist()
+        return record
+
+    def records(self):
+        for row in range(len(self)):
+            yield (self.key(row), self.row(row))
+
+    # 主キーの値 -> 行 (初めて使うときに作る)
+    @property
+    def primary_index(self) -> dict:
+        if self._primary_index == None:
+            column = self.columns[self.type_info.primary_key]
+            if self.is_string(self.type_info.primary_key):
+                column = self.pool.decode(column)
+            else:
+                column = column.tolist()
+            self._primary_index = dict(zip(column, range(len(column))))
+        return self._primary_index
+
+    # 主キーでレコードを引く。無ければ None
+    def at(self, primary_key) -> dict:
+        row = self.primary_index.get(primary_key)
+        return None if row == None else self.row(row)
+
+    # 値と等しい行の真偽値の列 (string も文字列で比較できる)
+    def equals(self, name:str, value):
+        if self.is_string(name):
+            index = self.pool.find(value)
+            if index < 0:
+                return numpy.zeros(len(self), dtype=bool)
+            value = index
+        return self.columns[name] == value
+
+    # mask (真偽値の列か行番号の列) で選んだレコードだけの表
+    def filter(self, mask):
+        return MDTable(self.type_info, self.fields, self.keys[mask], {name: column[mask] for name, column in self.columns.items()}, self.pool)
+
+    # 指定した field だけの表
+    def select(self, *names):
+        return MDTable(self.type_info, {name: self.fields[name] for name in names}, self.keys, {name: self.columns[name] for name in names}, self.pool)
+
+    # string は文字列順ではなく pool に入った順になる
+    def sort(self, name:str, descending:bool=False):
+        order = numpy.argsort(self.columns[name], axis=0, kind='stable')
+        if self.columns[name].ndim != 1:
+            order = order[:, 0]
+        return self.filter(order[::-1] if descending else order)
+
+    # operation: count / sum / mean / min / max
+    # by を指定すると field の値ごとに集計し { 値: 結果 } を返す (Vec2 の列は by に使えない)
+    def aggregate(self, name:str, operation:str, by:str=None):
+        if not operation in MDTable.AGGREGATES:
+            raise ValueError('unknown aggregate operation: %s' % operation)
+        column = self.columns[name]
+        if operation != 'count' and self.is_string(name):
+            raise ValueError('%s of string field is not supported: %s' % (operation, name))
+        if by == None:
+            if operation == 'count':
+                return len(column)
+            if len(column) == 0:
+                return None
+            return getattr(numpy, operation)(column, axis=0).tolist()
+        groups, inverse = numpy.unique(self.columns[by], return_inverse=True)
+        labels = self.pool.decode(groups) if self.is_string(by) else groups.tolist()
+        counts = numpy.bincount(inverse, minlength=len(groups))
+        if operation == 'count':
+            results = counts
+        elif operation in ('sum', 'mean'):
+            results = numpy.stack([numpy.bincount(inverse, weights=values, minlength=len(groups)) for values in column.reshape(len(column), -1).T], axis=-1)
+            if operation == 'mean':
+                results = results / counts[:, None]
+            results = results.reshape((len(groups),) + column.shape[1:])
+        else:
+            results = numpy.full((len(groups),) + column.shape[1:], numpy.inf if operation == 'min' else -numpy.inf)
+            getattr(numpy, 'minimum' if operation == 'min' else 'maximum').at(results, inverse, column)
+        return dict(zip(labels, results.tolist()))
+
+    # 列が使っているメモリ (文字列プールを除く)
+    @property
+    def nbytes(self) -> int:
+        return self.keys.nbytes + sum(column.nbytes for column in self.columns.values())
+
+    def describe(self) -> str:
+        lines = ['%s: %d records, %d bytes (+ %d pooled strings)' % (self.type_info.data_type_name, len(self), self.nbytes, len(self.pool))]
+        for name, field in self.fields.items():
+            column = self.columns[name]
+            if self.is_string(name):
+                detail = '%d unique' % len(numpy.unique(column))
+            elif len(column) == 0:
+                detail = '-'
+            else:
+                detail = 'min %s, max %s, mean %s' % tuple(self.aggregate(name, operation) for operation in ('min', 'max', 'mean'))
+            lines.append('  %-16s %-12s %s' % (name, field.raw_type, detail))
+        return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    basicConfig(level=INFO)
+    parser = argparse.ArgumentParser(description='実データを列で読み込み、fieldごとの統計を表示する')
+    parser.add_argument('types', nargs='+',
+        help='class/ からの相対パス (拡張子なし) e.g. kanji/KanjiParam')
+    args = parser.parse_args()
+    type_mgr = MDTypeManager()
+    pool = MDStringPool()
+    for type_path in args.types:
+        print(MDTable.load(type_mgr, type_path, pool).describe())
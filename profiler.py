@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+#coding:utf-8
+
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# 処理ごとの時間を計測する
+#   with Profiler.span('MDTypeManager.read'): ...
+#   Profiler.count('records', 10)
+# Profiler.enabled が False の間は何もしない (span は使い回しの空のコンテキストを返す)
+# 結果は Chrome の trace event 形式 (chrome://tracing / Perfetto で開ける) で書き出せる
+# ProcessPoolExecutor のワーカー内の処理は計測されないので、型ごと・ファイルごとの内訳を見るときは --jobs 1 で実行する
+class Profiler:
+    enabled = False
+    spans = list()    # (name, category, begin, end, thread_id, args)
+    counters = dict() # name -> 合計
+    origin = time.perf_counter()
+    NULL_SPAN = contextlib.nullcontext()
+
+    @classmethod
+    def enable(cls):
+        cls.enabled = True
+        cls.spans = list()
+        cls.counters = dict()
+        cls.origin = time.perf_counter()
+
+    @classmethod
+    def span(cls, name:str, category:str='tool', **args):
+        if not cls.enabled:
+            return Profiler.NULL_SPAN
+        return ProfilerSpan(name, category, args)
+
+    @classmethod
+    def count(cls, name:str, value:int=1):
+        if cls.enabled:
+            cls.counters[name] = cls.counters.get(name, 0) + value
+
+    # プロセスの最大常駐メモリ (バイト)。取れない環境では None
+    @staticmethod
+    def peak_memory() -> int:
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS はバイト、Linux は KiB
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    @classmethod
+    def chrome_trace(cls) -> dict:
+        pid = os.getpid()
+        events = list()
+        for name, category, begin, end, thread_id, args in cls.spans:
+            events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': (begin - cls.origin) * 1e6,
+                'dur': (end - begin) * 1e6,
+                'pid': pid,
+                'tid': thread_id,
+                'args': args})
+        end = max((span[3] for span in cls.spans), default=cls.origin)
+        for name, value in cls.counters.items():
+            events.append({'name': name, 'ph': 'C', 'ts': (end - cls.origin) * 1e6, 'pid': pid, 'args': {name: value}})
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'peak_memory': Profiler.peak_memory()}}
+
+    @classmethod
+    def write_chrome_trace(cls, path):
+        with open(path, 'w') as f:
+            json.dump(cls.chrome_trace(), f)
+
+    # 処理名ごとの合計時間と、時間のかかった個々の span 上位 top 件
+    @classmethod
+    def summary(cls, top:int=10) -> str:
+        totals = dict()
+        for name, _, begin, end, _, _ in cls.spans:
+            total, count = totals.get(name, (0.0, 0))
+            totals[name] = (total + end - begin, count + 1)
+        lines = ['-- time by phase ' + '-' * 40]
+        for name, (total, count) in sorted(totals.items(), key=lambda item: -item[1][0]):
+            lines.append('%-40s %10.2f ms %6d calls' % (name, total * 1000, count))
+        lines.append('-- slowest %d spans ' % top + '-' * 38)
+        for name, _, begin, end, _, args in sorted(cls.spans, key=lambda span: span[2] - span[3])[:top]:
+            detail = ', '.join('%s=%s' % (key, value) for key, value in args.items())
+            lines.append('%-40s %10.2f ms  %s' % (name, (end - begin) * 1000, detail))
+        if len(cls.counters) != 0:
+            lines.append('-- counters ' + '-' * 45)
+            for name, value in sorted(cls.counters.items()):
+                lines.append('%-40s %12d' % (name, value))
+        peak = Profiler.peak_memory()
+        if peak is not None:
+            lines.append('peak memory: %.1f MiB' % (peak / 1024 / 1024))
+        return '\n'.join(lines)
+
+    # --profile を受け取ったスクリプトの最後に呼ぶ
+    @classmethod
+    def report(cls, path, top:int=10):
+        if not cls.enabled:
+            return
+        cls.write_chrome_trace(path)
+        print(cls.summary(top), file=sys.stderr)
+        print('chrome trace: %s' % path, file=sys.stderr)
+
+
+class ProfilerSpan:
+    __slots__ = ('name', 'category', 'args', 'begin')
+
+    def __init__(self, name:str, category:str, args:dict):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        Profiler.spans.append((self.name, self.category, self.begin, time.perf_counter(), threading.get_ident(), self.args))
+        return False
+
+
+# --profile / --profile-output 引数 (各スクリプト共通)
+# --profile は値を取らない (後ろの位置引数を書き出し先として飲み込まないように)
+def add_profile_argument(parser):
+    parser.add_argument('--profile', action='store_true',
+        help='処理ごとの時間を計測し、Chrome trace形式で書き出す')
+    parser.add_argument('--profile-output', default='profile.json', metavar='TRACE_JSON',
+        help='--profile の書き出し先 (既定: profile.json)')
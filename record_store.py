@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+#coding:utf-8
+
+import os
+import pickle
+import hashlib
+import tempfile
+from toml_cache import TomlCache
+from id_manage import IdManager
+from logging import getLogger
+logger = getLogger(__name__)
+
+# validate_data.py --incremental で使う、前回の検証結果のレコード単位の記録
+# files: class/ からの相対パス -> {
+#     'stat': (mtime_ns, size),        ファイルが変わっていなければ読み込みも省く
+#     'type_hash': MDTypeInfo.content_hash(),
+#     'fingerprints': { key: レコードの内容のハッシュ },
+#     'record_errors': { key: [そのレコード単体の検証エラー] },
+#     'file_errors': [IDでない主キーの重複などファイル内のレコードをまたいだエラー],
+#     'ids': MDValidator.collect_ids の返り値 }
+# cross_errors: ファイルをまたいだエラー (主キーIDの重複・参照切れ)
+#     [{ 'path': .., 'key': .., 'id_name': .., 'value': .., 'error': {..} }, ...]
+# id.toml の内容が変わったら (IDの定義域の確認がすべて変わりうるので) 記録は捨てる
+class RecordStore:
+    PATH = TomlCache.DIRECTORY / 'records.store'
+    VERSION = 1
+
+    def __init__(self, id_hash:str):
+        self.id_hash = id_hash
+        self.files = dict()
+        self.cross_errors = list()
+
+    @classmethod
+    def load(cls, id_mgr:IdManager):
+        id_hash = id_mgr.content_hash()
+        try:
+            with open(cls.PATH, 'rb') as f:
+                stored = pickle.load(f)
+        except FileNotFoundError:
+            return cls(id_hash)
+        except Exception as e:
+            logger.warning('broken record store is ignored: %s' % e)
+            return cls(id_hash)
+        if stored.get('version') != RecordStore.VERSION or stored.get('id_hash') != id_hash:
+            logger.info('record store is outdated, all records will be validated')
+            return cls(id_hash)
+        store = cls(id_hash)
+        store.files = stored['files']
+        store.cross_errors = stored['cross_errors']
+        return store
+
+    def save(self):
+        stored = {
+            'version': RecordStore.VERSION,
+            'id_hash': self.id_hash,
+            'files': self.files,
+            'cross_errors': self.cross_errors}
+        os.makedirs(self.PATH.parent, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.PATH.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(stored, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.PATH)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    @classmethod
+    def clear(cls):
+        cls.PATH.unlink(missing_ok=True)
+
+    # レコードの内容のハッシュ (toml から読んだ素の dict/list/値)
+    @staticmethod
+    def fingerprint(record:dict) -> bytes:
+        return hashlib.blake2b(repr(record).encode('utf-8'), digest_size=8).digest()
@@ -2,29 +2,32 @@
 #coding:utf-8
 
 from pathlib import Path
-import toml
+from toml_cache import TomlCache
 import pprint
 
 # path.tomlに定義したパスを簡単に呼び出せるように
+# import 時には読み込まない。load() を呼ぶか、呼ばれないまま absolute() を使うとカレントの path.toml を読む
 class KanjiPath:
     root = Path()
     pathes = dict()
+    loaded = False
 
     @classmethod
-    def load(cls):
-        with open('path.toml', 'r') as f:
-            pathes_toml = toml.load(f)
+    def load(cls, path_toml='path.toml'):
+        pathes_toml = TomlCache.load(path_toml)
         pathes_toml = pathes_toml['tool']['path']
         cls.root = Path(pathes_toml['root'])
         for key, path in pathes_toml['relative'].items():
             cls.pathes[key] = Path(path)
+        cls.loaded = True
 
     @classmethod
     def absolute(cls, key) -> Path:
+        if not cls.loaded:
+            cls.load()
         return cls.root / cls.pathes[key]
 
-KanjiPath.load()
-
 if __name__ == "__main__":
+    KanjiPath.load()
     print('root: %s' % KanjiPath.root)
     pprint.pprint(KanjiPath.pathes)
@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+#coding:utf-8
+
+from pathlib import Path
+import os
+import sys
+import pickle
+import hashlib
+import tempfile
+import toml
+from profiler import Profiler
+from logging import getLogger, basicConfig, INFO
+logger = getLogger(__name__)
+
+# パース済みのtomlをディスクにキャッシュして、変更のないファイルの再パースを省く
+# キャッシュはパスごとに1ファイルで、mtime/サイズが同じならそのまま、違っても内容のハッシュが同じなら再利用する
+# 環境変数 KANJI_TOML_CACHE=0 か TomlCache.set_enabled(False) で無効化できる
+class TomlCache:
+    DIRECTORY = Path(__file__).parent / '.toml_cache'
+    # キャッシュ全体の上限。超えたら使われていない順に消す
+    MAX_BYTES = 256 * 1024 * 1024
+    # このプロセスから見たキャッシュ全体のバイト数の見積もり (None なら未集計)
+    # 書き込むたびに足し、上限を超えたときだけディレクトリを数え直して消す
+    total_bytes = None
+    enabled = os.environ.get('KANJI_TOML_CACHE', '1') != '0'
+
+    # 並列実行のワーカー (spawn で起動され、このモジュールを import し直す) にも伝わるよう環境変数も書き換える
+    @classmethod
+    def set_enabled(cls, enabled:bool):
+        cls.enabled = enabled
+        os.environ['KANJI_TOML_CACHE'] = '1' if enabled else '0'
+
+    @classmethod
+    def load(cls, path) -> dict:
+        with Profiler.span('toml.load', 'io', path=str(path)):
+            return cls.load_impl(path)
+
+    @classmethod
+    def load_impl(cls, path) -> dict:
+        path = Path(path).absolute()
+        if not cls.enabled:
+            with open(path) as f:
+                return TomlCache.plain(toml.load(f))
+        stat = path.stat()
+        entry_path = cls.entry_path(path)
+        entry = cls.read_entry(entry_path)
+        if entry != None and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            logger.debug('cache hit: %s' % path)
+            os.utime(entry_path)
+            return entry['data']
+        with open(path, 'rb') as f:
+            content = f.read()
+        content_hash = hashlib.sha1(content).hexdigest()
+        if entry != None and entry['hash'] == content_hash:
+            logger.debug('cache hit (touched): %s' % path)
+            data = entry['data']
+        else:
+            logger.debug('cache miss: %s' % path)
+            data = TomlCache.plain(toml.loads(content.decode('utf-8')))
+        cls.write_entry(entry_path, {
+            'path': str(path),
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'hash': content_hash,
+            'data': data})
+        return data
+
+    @classmethod
+    def clear(cls):
+        if not cls.DIRECTORY.is_dir():
+            return
+        for entry_path in cls.DIRECTORY.glob('*.pickle'):
+            entry_path.unlink()
+        cls.total_bytes = None
+
+    @classmethod
+    def entry_path(cls, path:Path) -> Path:
+        return cls.DIRECTORY / (hashlib.sha1(str(path).encode('utf-8')).hexdigest() + '.pickle')
+
+    # 壊れている・古い形式のキャッシュは無かったものとして扱う
+    @classmethod
+    def read_entry(cls, entry_path:Path) -> dict:
+        try:
+            with open(entry_path, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning('broken cache is ignored: %s (%s)' % (entry_path.name, e))
+            return None
+
+    # 並列に動くプロセス同士で壊さないよう、一時ファイルに書いてから置き換える
+    @classmethod
+    def write_entry(cls, entry_path:Path, entry:dict):
+        try:
+            os.makedirs(cls.DIRECTORY, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=cls.DIRECTORY, suffix='.tmp')
+        except OSError as e:
+            logger.warning('failed to write cache: %s (%s)' % (entry_path.name, e))
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+                size = f.tell()
+            replaced_size = cls.entry_size(entry_path)
+            os.replace(temp_path, entry_path)
+        except Exception as e:
+            os.unlink(temp_path)
+            logger.warning('failed to write cache: %s (%s)' % (entry_path.name, e))
+            return
+        if cls.total_bytes == None:
+            cls.evict()
+            return
+        cls.total_bytes += size - replaced_size
+        if cls.total_bytes > cls.MAX_BYTES:
+            cls.evict()
+
+    @staticmethod
+    def entry_size(entry_path:Path) -> int:
+        try:
+            return entry_path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    # 上限を超えていたら最終使用 (mtime) が古い順に、上限の3/4まで消す
+    # (上限ちょうどまでしか消さないと、その後は書き込むたびに数え直すことになる)
+    @classmethod
+    def evict(cls):
+        entries = list()
+        for entry_path in cls.DIRECTORY.glob('*.pickle'):
+            try:
+                stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry_path))
+        total = sum(size for _, size, _ in entries)
+        if total <= cls.MAX_BYTES:
+            cls.total_bytes = total
+            return
+        for _, size, entry_path in sorted(entries):
+            if total <= cls.MAX_BYTES * 3 // 4:
+                break
+            logger.debug('evict: %s' % entry_path.name)
+            entry_path.unlink(missing_ok=True)
+            total -= size
+        cls.total_bytes = total
+
+    # toml の inline table はローカルクラスで pickle できないので素の dict/list に直す
+    @staticmethod
+    def plain(value):
+        if isinstance(value, dict):
+            return {key: TomlCache.plain(child) for key, child in value.items()}
+        if isinstance(value, list):
+            return [TomlCache.plain(child) for child in value]
+        return value
+
+
+if __name__ == "__main__":
+    basicConfig(level=INFO)
+    if len(sys.argv) > 1 and sys.argv[1] == 'clear':
+        TomlCache.clear()
+        logger.info('cleared: %s' % TomlCache.DIRECTORY)
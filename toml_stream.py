@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+#coding:utf-8
+
+import re
+import toml
+from toml_cache import TomlCache
+from logging import getLogger
+logger = getLogger(__name__)
+
+# 巨大な class/*.toml をファイル全体を読み込まずに1レコードずつ扱う
+# [masterdata.<key>] の見出しごとに区切り、区切った文字列だけを toml としてパースする
+# [masterdata.<key>.pos] のような同じ key の下位テーブルは同じレコードに含める
+# 複数行文字列・複数行の配列の中の見出しのような行は区切りとして扱わない
+# 区切れない書き方 (見出しのない [masterdata] や masterdata.<key> = {..}、
+# 別の key を挟んだ下位テーブル) のファイルは UnsplittableToml を投げるので、ファイル全体を読み込むこと
+
+HEADER = re.compile(r'''^\s*\[\[?\s*(?P<table>[A-Za-z0-9_-]+)\s*\.\s*(?P<key>"(?:[^"\\]|\\.)*"|'[^']*'|[A-Za-z0-9_-]+)''')
+# 見出しの先頭のキー (どのテーブルの見出しか)
+HEADER_TABLE = re.compile(r'''^\s*\[\[?\s*(?P<table>"(?:[^"\\]|\\.)*"|'[^']*'|[A-Za-z0-9_-]+)''')
+MULTILINE_QUOTES = ('"""', "'''")
+# 行の中で文字列・コメント・括弧の始まりになりうるもの
+TOKEN = re.compile(r'''"""|\'\'\'|["'#\[\]{}]''')
+
+
+class UnsplittableToml(Exception):
+    pass
+
+
+# 1レコード分の (開始行, toml文字列) を順に返す
+# 最初の見出しより前の行 (コメントなど) は読み飛ばす
+def iterate_sections(path, table:str='masterdata'):
+    lines = list()
+    begin = None
+    current_key = None
+    keys = set()
+    # 別のテーブルの見出しの後 (その下の代入は table のものではない)
+    in_other_table = False
+    quote = None
+    depth = 0
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if quote == None and depth == 0:
+                stripped = line.strip()
+                if stripped.startswith('['):
+                    match = HEADER.match(line)
+                    if match != None and match.group('table') == table:
+                        key = unquote_key(match.group('key'))
+                        if key != current_key:
+                            if key in keys:
+                                raise UnsplittableToml('%s: subtables of [%s.%s] are not contiguous (line %d)' % (path, table, key, number))
+                            keys.add(key)
+                            if begin != None:
+                                yield (begin, ''.join(lines))
+                            lines = list()
+                            begin = number
+                            current_key = key
+                        in_other_table = False
+                    elif header_table(line) == table:
+                        raise UnsplittableToml('%s: [%s] without a record key (line %d)' % (path, table, number))
+                    else:
+                        in_other_table = True
+                elif stripped != '' and not stripped.startswith('#') and begin == None and not in_other_table:
+                    raise UnsplittableToml('%s: a value outside of [%s.<key>] (line %d)' % (path, table, number))
+            quote, depth = scan_line(line, quote, depth)
+            if begin != None:
+                lines.append(line)
+    if begin != None:
+        yield (begin, ''.join(lines))
+
+def header_table(line:str) -> str:
+    match = HEADER_TABLE.match(line)
+    return None if match == None else unquote_key(match.group('table'))
+
+# "a" / 'a' / a をどれも a にする
+def unquote_key(key:str) -> str:
+    if key.startswith("'"):
+        return key[1:-1]
+    if key.startswith('"'):
+        return toml.loads('k = %s' % key)['k'] if '\\' in key else key[1:-1]
+    return key
+
+# 行末時点の (開いている複数行文字列の引用符, 閉じていない [ と { の数) を返す
+# 1行の文字列とコメントの中の括弧は数えない
+def scan_line(line:str, quote:str, depth:int) -> (str, int):
+    position = 0
+    while True:
+        if quote != None:
+            index = line.find(quote, position)
+            if index < 0:
+                return quote, depth
+            quote = None
+            position = index + 3
+            continue
+        match = TOKEN.search(line, position)
+        if match == None:
+            return quote, depth
+        token = match.group()
+        position = match.end()
+        if token in MULTILINE_QUOTES:
+            quote = token
+        elif token == '#':
+            return quote, depth
+        elif token == '"':
+            position = end_of_basic_string(line, position)
+        elif token == "'":
+            end = line.find("'", position)
+            position = len(line) if end < 0 else end + 1
+        elif token in '[{':
+            depth += 1
+        else:
+            depth = max(0, depth - 1)
+
+def end_of_basic_string(line:str, position:int) -> int:
+    while True:
+        end = line.find('"', position)
+        if end < 0:
+            return len(line)
+        backslashes = 0
+        while end - backslashes - 1 >= position and line[end - backslashes - 1] == '\\':
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return end + 1
+        position = end + 1
+
+# 区切った文字列をパースし、table 以下の { key: record } を返す
+def parse_section(text:str, table:str='masterdata') -> dict:
+    return TomlCache.plain(toml.loads(text)).get(table, dict())
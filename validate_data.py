@@ -2,82 +2,679 @@
 #coding:utf-8
 
 from pathlib import Path
-import toml
+import sys
+import os
+import json
+import argparse
+from itertools import chain
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from toml_cache import TomlCache
+from toml_stream import iterate_sections, parse_section, UnsplittableToml
+from profiler import Profiler, add_profile_argument
 from repository_path import KanjiPath
-from master_type import MDTypeManager, MDTypeInfo
+from master_type import MDTypeManager, MDTypeInfo, MDField
+from id_manage import IdManager, import_numpy
+from record_store import RecordStore
 from logging import getLogger, basicConfig, DEBUG, INFO
 logger = getLogger(__name__)
 
 
 class MDValidator:
-    def __init__(self):
+    # 型名ごとに許される値のPythonでの型 (Vec2は別途確認する)
+    VALUE_TYPES = {
+        'int': (int,),
+        'float': (float, int),
+        'double': (float, int),
+        'string': (str,),
+        'Vec2': (list, dict)}
+    # streaming のとき、まとめて検証するレコード数 (メモリに持つのはこの件数分だけ)
+    STREAM_BATCH = 64
+
+    # 読み込み済みの型情報・ID情報を渡すとそれを使う
+    # streaming: ファイル全体を読み込まず [masterdata.<key>] ごとにパースして検証する
+    # max_errors: エラーがこの数に達したら残りのレコード・ファイルを検証せずに終える
+    def __init__(self, type_mgr:MDTypeManager=None, id_mgr:IdManager=None, streaming:bool=False, max_errors:int=None):
         self.root_path = KanjiPath.absolute('md_class')
-        self.type_mgr = MDTypeManager()
+        self.type_mgr = type_mgr if type_mgr != None else MDTypeManager()
+        self.id_mgr = id_mgr if id_mgr != None else IdManager()
+        self.streaming = streaming
+        self.max_errors = max_errors
+
+    # 全ファイルを検証し、結果をまとめたレポートを返す
+    # jobs > 1 ならファイル単位でプロセスに振り分ける (結果の順番はファイルパス順で固定)
+    def validate(self, jobs:int=1) -> dict:
+        with Profiler.span('MDValidator.validate', 'validate', jobs=jobs):
+            return self.validate_impl(jobs)
+
+    def validate_impl(self, jobs:int=1) -> dict:
+        tasks = [self.toml_task(toml_path) for toml_path in sorted(self.root_path.glob('**/*.toml'))]
+        if jobs == 1 or len(tasks) <= 1:
+            results = list()
+            for task in tasks:
+                results.append(self.validate_toml(*task))
+                if self.reached_max_errors(sum(len(result['errors']) for result in results)):
+                    break
+        else:
+            # 並列のときはファイルごとに max_errors で打ち切る
+            with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(self,)) as executor:
+                results = list(executor.map(validate_toml_task, tasks))
+        aborted = self.reached_max_errors(sum(len(result['errors']) for result in results))
+        # 打ち切ったときは主キーIDが揃っていないので、ファイルをまたいだ確認はしない
+        if aborted:
+            for result in results:
+                result.pop('ids', None)
+        else:
+            self.validate_references(results)
+        report = MDValidator.make_report(results)
+        report['aborted'] = aborted
+        return report
+
+    def reached_max_errors(self, error_count:int) -> bool:
+        return self.max_errors != None and error_count >= self.max_errors
 
-    def validate(self):
-        for toml_path in self.root_path.glob('**/*.toml'): # e.g. 'class/kanji/KanjiParam.toml'
-            sub_directories = tuple(str(toml_path.parent.relative_to(self.root_path)).split('/'))
-            type_name = toml_path.stem
-            self.validate_toml(sub_directories, type_name)
+    # ファイルをまたいだ確認: 主キーIDの重複と、ID型fieldの参照切れ
+    # 各ファイルの検証結果に集めておいたIDを1つの索引にまとめて照合し、エラーは該当ファイルの結果に追加する
+    def validate_references(self, results:list):
+        with Profiler.span('MDValidator.validate_references', 'validate'):
+            index = MDReferenceIndex(self.id_mgr)
+            for result_index, result in enumerate(results):
+                index.add(result_index, result.pop('ids', None))
+            for result_index, key, _, _, message, fields in index.find_errors(results):
+                self.report_error(results[result_index]['errors'], key, message, fields)
 
-    def validate_toml(self, sub_directories:tuple, type_name:str):
+    # 前回の検証結果 (RecordStore) を使い、追加・変更されたレコードと型定義が変わった型のレコードだけを検証する
+    # 変わっていないレコードのエラーは前回のものをそのまま報告する
+    # ファイルをまたいだ確認も、変わった・消えたレコードの主キーIDとそれを参照しているレコードについてだけやり直す
+    def validate_incremental(self, store:RecordStore, jobs:int=1) -> dict:
+        with Profiler.span('MDValidator.validate_incremental', 'validate', jobs=jobs):
+            return self.validate_incremental_impl(store, jobs)
+
+    def validate_incremental_impl(self, store:RecordStore, jobs:int=1) -> dict:
+        if self.streaming or self.max_errors != None:
+            logger.warning('--stream and --max-errors are ignored in incremental validation')
+        tasks = [self.toml_task(toml_path) for toml_path in sorted(self.root_path.glob('**/*.toml'))]
+        tasks = [task + (store.files.get(self.toml_relative_path(*task)),) for task in tasks]
+        if jobs == 1 or len(tasks) <= 1:
+            validated = [self.validate_toml_incremental(*task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(self,)) as executor:
+                validated = list(executor.map(validate_toml_incremental_task, tasks))
+        results = [result for result, _ in validated]
+        paths = {result['path']: index for index, result in enumerate(results)}
+        changed_keys = {index: result.pop('changed') for index, result in enumerate(results)}
+        affected = dict() # ID名 -> 変わった・消えたレコードの主キーIDの集合
+        for result in results:
+            for id_name, values in result.pop('affected'):
+                affected.setdefault(id_name, set()).update(values)
+        # 消えたファイルの主キーIDもすべて対象にする
+        for path, entry in store.files.items():
+            if not path in paths and entry['ids']['primary'] != None:
+                id_name, _, values = entry['ids']['primary']
+                affected.setdefault(id_name, set()).update(values)
+        store.files = {result['path']: entry for result, entry in validated if entry != None}
+        with Profiler.span('MDValidator.validate_references', 'validate'):
+            index = MDReferenceIndex(self.id_mgr)
+            for result_index, (_, entry) in enumerate(validated):
+                index.add(result_index, None if entry == None else entry['ids'])
+            cross_errors = [
+                cross_error for cross_error in store.cross_errors
+                if cross_error['path'] in paths
+                and not cross_error['key'] in changed_keys[paths[cross_error['path']]]
+                and not cross_error['value'] in affected.get(cross_error['id_name'], ())]
+            for cross_error in cross_errors:
+                results[paths[cross_error['path']]]['errors'].append(cross_error['error'])
+            for result_index, key, id_name, value, message, fields in index.find_errors(results, changed_keys, affected):
+                errors = results[result_index]['errors']
+                self.report_error(errors, key, message, fields)
+                cross_errors.append({'path': results[result_index]['path'], 'key': key, 'id_name': id_name, 'value': value, 'error': errors[-1]})
+        store.cross_errors = cross_errors
+        report = MDValidator.make_report(results)
+        report['aborted'] = False
+        return report
+
+    # validate_toml の、前回の記録 previous と比べて変わったレコードだけを検証する版
+    # (検証結果, 今回の記録) を返す。検証結果には次の2つが付く (validate_incremental_impl で取り除く)
+    #   'changed': 検証し直した・消えたレコードの key の集合
+    #   'affected': [(ID名, 変わった・消えたレコードの新旧の主キーIDの列)]
+    def validate_toml_incremental(self, sub_directories:tuple, type_name:str, previous:dict) -> tuple:
         toml_name = type_name + '.toml'
+        result = {
+            'path': self.toml_relative_path(sub_directories, type_name),
+            'type': type_name,
+            'records': 0,
+            'errors': list()}
+        toml_path = self.root_path.joinpath(*sub_directories) / toml_name
+        stat = toml_path.stat()
+        type_info = self.find_type_info(sub_directories, type_name)
+        type_hash = None if type_info == None else type_info.content_hash()
+        if previous != None and previous['stat'] == (stat.st_mtime_ns, stat.st_size) and previous['type_hash'] == type_hash:
+            logger.debug('unchanged: %s' % result['path'])
+            MDValidator.restore_result(result, previous)
+            result['changed'] = set()
+            result['affected'] = list()
+            return (result, previous)
         logger.info('validate... : %s (%s)' % (toml_name, '/'.join(sub_directories)))
-        data = self.load(sub_directories, toml_name)
-        for dir in sub_directories:
-            if dir == '.':
-                type_info_list = self.type_mgr.dict_info[MDTypeManager.ROOT]
-            else:
-                type_info_list = self.type_mgr.dict_info[dir]
-        data_have_error = list()
+        with Profiler.span('MDValidator.validate_toml', 'validate', path=result['path']):
+            entry = self.validate_changed_records(sub_directories, toml_name, type_info, previous, result)
+        if entry != None:
+            entry['stat'] = (stat.st_mtime_ns, stat.st_size)
+            entry['type_hash'] = type_hash
+        return (result, entry)
+
+    # 変わったレコードを検証して今回の記録を返す (型定義が無い・読み込めないときは None)
+    def validate_changed_records(self, sub_directories:tuple, toml_name:str, type_info:MDTypeInfo, previous:dict, result:dict) -> dict:
+        old_keys = set() if previous == None else set(previous['fingerprints'])
+        result['changed'] = old_keys
+        result['affected'] = MDValidator.primary_ids(previous, old_keys)
+        if type_info == None:
+            self.report_error(result['errors'], None, 'There is no type definition for %s.' % toml_name)
+            return None
+        try:
+            data = self.load(sub_directories, toml_name)
+        except Exception as e:
+            self.report_error(result['errors'], None, 'Failed to load %s: %s' % (toml_name, e))
+            return None
+        fingerprints = {key: RecordStore.fingerprint(data[key]) for key in data}
+        reusable = previous != None and previous['type_hash'] == type_info.content_hash()
+        old_fingerprints = previous['fingerprints'] if reusable else dict()
+        changed = {key for key in data if old_fingerprints.get(key) != fingerprints[key]}
+        deleted = old_keys - data.keys()
+        record_errors = {key: errors for key, errors in previous['record_errors'].items() if key in data and not key in changed} if reusable else dict()
+        if len(changed) != 0:
+            changed_data = {key: data[key] for key in data if key in changed}
+            errors = list()
+            for key in changed_data:
+                self.vaildate_necessary_and_sufficient(key, changed_data[key], type_info, errors)
+            self.validate_values(changed_data, type_info, errors)
+            for error in errors:
+                record_errors.setdefault(error['key'], list()).append(error)
+            Profiler.count('records_validated', len(changed_data))
+            Profiler.count('fields_validated', len(changed_data) * len(type_info.fields))
+        # IDでない主キーの重複はファイル内のレコードをまたぐので、ファイルが変わったら全体で確認し直す
+        file_errors = list()
+        self.validate_primary_key(data, type_info, file_errors)
+        entry = {
+            'fingerprints': fingerprints,
+            'record_errors': record_errors,
+            'file_errors': file_errors,
+            'ids': self.collect_ids(data, type_info)}
+        MDValidator.restore_result(result, entry)
+        result['changed'] = changed | deleted
+        result['affected'] = MDValidator.primary_ids(previous, changed | deleted) + MDValidator.primary_ids(entry, changed)
+        logger.info('%d changed and %d deleted records in %s' % (len(changed), len(deleted), toml_name))
+        return entry
+
+    # 記録から検証結果の件数・エラーを組み立てる
+    @staticmethod
+    def restore_result(result:dict, entry:dict):
+        result['records'] = len(entry['fingerprints'])
+        result['errors'] = [error for key in entry['fingerprints'] for error in entry['record_errors'].get(key, ())] + entry['file_errors']
+
+    # 記録の中の、keys のレコードの主キーID [(ID名, 値の列)]
+    @staticmethod
+    def primary_ids(entry:dict, keys:set) -> list:
+        if entry == None or entry['ids']['primary'] == None:
+            return list()
+        id_name, primary_keys, values = entry['ids']['primary']
+        return [(id_name, [value for key, value in zip(primary_keys, values) if key in keys])]
+
+    # e.g. 'class/kanji/KanjiParam.toml' -> (('kanji',), 'KanjiParam')
+    def toml_task(self, toml_path:Path) -> tuple:
+        sub_directories = tuple(str(toml_path.parent.relative_to(self.root_path)).split('/'))
+        type_name = toml_path.stem
+        return (sub_directories, type_name)
+
+    # e.g. (('kanji',), 'KanjiParam') -> 'kanji/KanjiParam.toml'
+    def toml_relative_path(self, sub_directories:tuple, type_name:str) -> str:
+        return str(Path(*sub_directories) / (type_name + '.toml'))
+
+    # 1ファイル分の検証結果を返す
+    # { 'path': 'kanji/KanjiParam.toml', 'type': 'KanjiParam', 'records': 2, 'errors': [...] }
+    def validate_toml(self, sub_directories:tuple, type_name:str) -> dict:
+        with Profiler.span('MDValidator.validate_toml', 'validate', path='/'.join(sub_directories + (type_name,))):
+            result = self.validate_toml_impl(sub_directories, type_name)
+        Profiler.count('records_validated', result['records'])
+        return result
+
+    def validate_toml_impl(self, sub_directories:tuple, type_name:str) -> dict:
+        toml_name = type_name + '.toml'
+        logger.info('validate... : %s (%s)' % (toml_name, '/'.join(sub_directories)))
+        result = {
+            'path': self.toml_relative_path(sub_directories, type_name),
+            'type': type_name,
+            'records': 0,
+            'errors': list()}
+        type_info = self.find_type_info(sub_directories, type_name)
+        if type_info == None:
+            self.report_error(result['errors'], None, 'There is no type definition for %s.' % toml_name)
+            return result
+        if self.streaming:
+            self.validate_stream(sub_directories, toml_name, type_info, result)
+        else:
+            try:
+                data = self.load(sub_directories, toml_name)
+            except Exception as e:
+                self.report_error(result['errors'], None, 'Failed to load %s: %s' % (toml_name, e))
+                return result
+            self.validate_records(data, type_info, result, dict())
+        if len(result['errors']) == 0:
+            logger.info('All data is validated : %d records in %s' % (result['records'], toml_name))
+        return result
+
+    # max_errors があるときは、残りの許容数より多くは1度に検証しない (打ち切りが遅れないように)
+    def stream_batch_size(self, error_count:int) -> int:
+        if self.max_errors == None:
+            return MDValidator.STREAM_BATCH
+        return max(1, min(MDValidator.STREAM_BATCH, self.max_errors - error_count))
+
+    # 読み込んだレコードをまとめて検証し、件数・エラー・IDを result に足していく
+    # primary_keys: IDでない主キーの重複確認用 (値 -> key)。ファイル内で使い回す
+    def validate_records(self, data:dict, type_info:MDTypeInfo, result:dict, primary_keys:dict):
+        result['records'] += len(data)
+        Profiler.count('fields_validated', len(data) * len(type_info.fields))
         for key in data: # key = yama, tera, ...
             record = data[key] # e.g. { 'id': 0, 'character': '山', ...}
-            type_info = type_info_list[type_name] # e.g. { 'id': MDField(id, KanjiID), ... }
-            if not self.vaildate_necessary_and_sufficient(key, record, type_info):
-                data_have_error.append('%s::%s' % (type_name, key))
-        if len(data_have_error) == 0:
-            logger.info('All data is validated : %d records in %s' % (len(data), toml_name))
+            self.vaildate_necessary_and_sufficient(key, record, type_info, result['errors'])
+        self.validate_values(data, type_info, result['errors'])
+        self.validate_primary_key(data, type_info, result['errors'], primary_keys)
+        MDValidator.merge_ids(result, self.collect_ids(data, type_info))
+
+    # [masterdata.<key>] ごとにパースし、STREAM_BATCH 件ずつ検証しては捨てる
+    # パースできないレコードはエラーにして次のレコードへ進む
+    # レコードごとに区切れない書き方のファイルは、それまでの結果を捨ててファイル全体を読み込んで検証する
+    def validate_stream(self, sub_directories:tuple, toml_name:str, type_info:MDTypeInfo, result:dict):
+        toml_path = self.root_path.joinpath(*sub_directories) / toml_name
+        logger.debug('stream ' + str(toml_path.absolute()))
+        try:
+            self.validate_stream_sections(toml_path, toml_name, type_info, result)
+        except UnsplittableToml as e:
+            logger.warning('%s, validating after loading the whole file' % e)
+            result['records'] = 0
+            result['errors'].clear()
+            result.pop('ids', None)
+            try:
+                data = self.load(sub_directories, toml_name)
+            except Exception as e:
+                self.report_error(result['errors'], None, 'Failed to load %s: %s' % (toml_name, e))
+                return
+            self.validate_records(data, type_info, result, dict())
+
+    def validate_stream_sections(self, toml_path:Path, toml_name:str, type_info:MDTypeInfo, result:dict):
+        keys = set()
+        primary_keys = dict()
+        batch = dict()
+        sections = 0
+        try:
+            for line, text in iterate_sections(toml_path):
+                sections += 1
+                try:
+                    records = parse_section(text)
+                except Exception as e:
+                    self.report_error(result['errors'], None, 'Failed to parse %s (line %d): %s' % (toml_name, line, e))
+                    continue
+                for key, record in records.items():
+                    if key in keys:
+                        self.report_error(result['errors'], key, 'The key [%s] is defined more than once. (line %d)' % (key, line))
+                        continue
+                    keys.add(key)
+                    batch[key] = record
+                if len(batch) >= self.stream_batch_size(len(result['errors'])):
+                    self.validate_records(batch, type_info, result, primary_keys)
+                    batch = dict()
+                    if self.reached_max_errors(len(result['errors'])):
+                        logger.warning('validation of %s is aborted after %d errors' % (toml_name, len(result['errors'])))
+                        return
+        except UnsplittableToml:
+            raise
+        except Exception as e:
+            self.report_error(result['errors'], None, 'Failed to load %s: %s' % (toml_name, e))
+            return
+        if len(batch) != 0:
+            self.validate_records(batch, type_info, result, primary_keys)
+        if sections == 0:
+            self.report_error(result['errors'], None, 'There is no [masterdata.<key>] record in %s.' % toml_name)
+
+    # e.g. ('kanji',) / 'KanjiParam' -> { 'id': MDField(id, KanjiID), ... } を持つMDTypeInfo
+    def find_type_info(self, sub_directories:tuple, type_name:str) -> MDTypeInfo:
+        if sub_directories == ('.',):
+            key = MDTypeManager.ROOT
+        else:
+            key = '/'.join(sub_directories)
+        return self.type_mgr.dict_info.get(key, dict()).get(type_name)
 
     def load(self, sub_directories:tuple, toml_name:str) -> dict:
-        for dir in sub_directories:
-            toml_path = self.root_path / dir
+        toml_path = self.root_path.joinpath(*sub_directories)
         logger.debug('load ' + str(toml_path.absolute()))
-        dict_toml = dict()
-        with open(toml_path / toml_name) as f:
-            dict_toml = toml.load(f)
+        dict_toml = TomlCache.load(toml_path / toml_name)
         return dict_toml['masterdata']
 
+    # エラーをログに出しつつ、errors が渡されていればレポート用に記録する
+    def report_error(self, errors:list, key:str, message:str, fields:tuple=()):
+        logger.error(message)
+        for field in fields:
+            logger.error('> ' + field)
+        if errors != None:
+            errors.append({'key': key, 'message': message, 'fields': list(fields)})
+
     # type_infoで定義されているfieldとrecordの持つfieldが必要十分か
-    def vaildate_necessary_and_sufficient(self, key:str, record:dict, type_info:MDTypeInfo) -> bool:
-        return self.vaildate_sufficient(key, record, type_info) and self.vaildate_necessary(key, record, type_info)
+    def vaildate_necessary_and_sufficient(self, key:str, record:dict, type_info:MDTypeInfo, errors:list=None) -> bool:
+        return self.vaildate_sufficient(key, record, type_info, errors) and self.vaildate_necessary(key, record, type_info, errors)
 
     # type_infoで定義されているfieldがすべてrecordに含まれているか
-    def vaildate_sufficient(self, key:str, record:dict, type_info:MDTypeInfo) -> bool:
+    def vaildate_sufficient(self, key:str, record:dict, type_info:MDTypeInfo, errors:list=None) -> bool:
         lack_fields = list()
         for necessary_field in type_info.fields:
             if not necessary_field in record:
                 lack_fields.append(necessary_field)
         if len(lack_fields) != 0:
-            logger.error('The submitted data contains missing fields. (key: [%s])' % key)
-            for lack_field in lack_fields:
-                logger.error('> ' + lack_field)
+            self.report_error(errors, key, 'The submitted data contains missing fields. (key: [%s])' % key, lack_fields)
         return len(lack_fields) == 0
 
     # recordに入稿されているfieldがすべてtype_infoに含まれているか
-    def vaildate_necessary(self, key:str, record:dict, type_info:MDTypeInfo) -> bool:
+    def vaildate_necessary(self, key:str, record:dict, type_info:MDTypeInfo, errors:list=None) -> bool:
         unnecessary_fields = list()
         for exist_field in record:
             if not exist_field in type_info.fields:
                 unnecessary_fields.append(exist_field)
         if len(unnecessary_fields) != 0:
-            logger.error('The submitted data contains unnecessary fields. (key: [%s])' % key)
-            for unnecessary_field in unnecessary_fields:
-                logger.error('> ' + unnecessary_field)
+            self.report_error(errors, key, 'The submitted data contains unnecessary fields. (key: [%s])' % key, unnecessary_fields)
         return len(unnecessary_fields) == 0
 
+    # fieldごとに全recordの値を列として取り出し、型とIDの定義域をまとめて確認する
+    def validate_values(self, data:dict, type_info:MDTypeInfo, errors:list=None) -> bool:
+        invalid = dict() # key -> ['field: 理由', ...]
+        for field in type_info.fields.values():
+            keys = [key for key in data if field.name in data[key]]
+            column = [data[key][field.name] for key in keys]
+            for index, reason in self.validate_column(field, column):
+                invalid.setdefault(keys[index], list()).append('%s: %s' % (field.name, reason))
+        for key in data:
+            if key in invalid:
+                self.report_error(errors, key, 'The submitted data contains invalid values. (key: [%s])' % key, invalid[key])
+        return len(invalid) == 0
+
+    # IDでない主キーはファイル内で重複していないか (IDの主キーは validate_references でまとめて確認する)
+    # primary_keys: それまでに現れた値 -> key (分けて検証するときに渡す)
+    def validate_primary_key(self, data:dict, type_info:MDTypeInfo, errors:list=None, primary_keys:dict=None) -> bool:
+        field = type_info.fields.get(type_info.primary_key)
+        if field == None or field.is_id:
+            return True
+        if primary_keys == None:
+            primary_keys = dict()
+        valid = True
+        for key in data:
+            value = data[key].get(field.name)
+            if not isinstance(value, (int, float, str)):
+                continue
+            if value in primary_keys:
+                self.report_error(errors, key, 'The primary key %s = %r is duplicated. (key: [%s])' % (field.name, value, key), (primary_keys[value], key))
+                valid = False
+            else:
+                primary_keys[value] = key
+        return valid
+
+    # ファイルをまたいだ確認のため、ID型fieldの値を (ID名, key の列, 値の列) で取り出す
+    # 型違い・定義域外の値はファイル単位の検証で報告済みなので含めない
+    # { 'primary': ('Kanji', [...], [...]) or None, 'references': [('owner', 'Chara', [...], [...]), ...] }
+    def collect_ids(self, data:dict, type_info:MDTypeInfo) -> dict:
+        ids = {'primary': None, 'references': list()}
+        for field in type_info.fields.values():
+            if not field.is_id:
+                continue
+            id_info = self.id_mgr.search_id_by_name(field.type_name)
+            if id_info == None:
+                continue
+            keys = list()
+            values = list()
+            for key in data:
+                value = data[key].get(field.name)
+                if type(value) is int and id_info.in_range(value):
+                    keys.append(key)
+                    values.append(value)
+            if field.is_primary_key:
+                ids['primary'] = (field.type_name, keys, values)
+            else:
+                ids['references'].append((field.name, field.type_name, keys, values))
+        return ids
+
+    # 分けて集めたIDを result['ids'] にまとめる
+    @staticmethod
+    def merge_ids(result:dict, ids:dict):
+        if not 'ids' in result:
+            result['ids'] = ids
+            return
+        merged = result['ids']
+        if ids['primary'] != None:
+            merged['primary'][1].extend(ids['primary'][1])
+            merged['primary'][2].extend(ids['primary'][2])
+        for merged_reference, reference in zip(merged['references'], ids['references']):
+            merged_reference[2].extend(reference[2])
+            merged_reference[3].extend(reference[3])
+
+    # 1列分の値を確認し、不正な値の (列中の位置, 理由) を返す
+    def validate_column(self, field:MDField, column:list) -> list:
+        if field.is_id:
+            return self.validate_id_column(field, column)
+        value_types = MDValidator.VALUE_TYPES[field.type_name]
+        invalid = MDValidator.find_invalid_types(column, value_types, field.type_name)
+        if field.type_name == 'Vec2':
+            invalid.extend(MDValidator.find_invalid_vec2(column, {index for index, _ in invalid}))
+            invalid.sort()
+        return invalid
+
+    # 値が int であり、かつIDの定義域に収まっているか
+    def validate_id_column(self, field:MDField, column:list) -> list:
+        invalid = MDValidator.find_invalid_types(column, (int,), 'int')
+        id_info = self.id_mgr.search_id_by_name(field.type_name)
+        if id_info == None:
+            return [(index, '%sID is not defined in id.toml' % field.type_name) for index in range(len(column))]
+        wrong_type = {index for index, _ in invalid}
+        indices = [index for index in range(len(column)) if not index in wrong_type]
+        values = [column[index] for index in indices]
+        numpy = import_numpy()
+        if numpy is not None:
+            array = numpy.array(values, dtype=numpy.int64)
+            out_of_range = numpy.flatnonzero((array < id_info.begin) | (array > id_info.end)).tolist()
+        else:
+            out_of_range = [i for i, value in enumerate(values) if not id_info.in_range(value)]
+        for i in out_of_range:
+            invalid.append((indices[i], '%d is out of %sID range (%d-%d)' % (values[i], field.type_name, id_info.begin, id_info.end)))
+        invalid.sort()
+        return invalid
+
+    # 列に含まれる値の型を集合で調べ、想定外の型があるときだけ位置を探す
+    # toml の inline table などサブクラスは許すが、bool は int のサブクラスでも数値としては扱わない
+    @staticmethod
+    def find_invalid_types(column:list, value_types:tuple, type_name:str) -> list:
+        types = list(map(type, column))
+        rejected = {t for t in set(types) if not t in value_types and (t is bool or not issubclass(t, value_types))}
+        if len(rejected) == 0:
+            return list()
+        return [(index, '%r is not %s' % (column[index], type_name)) for index, t in enumerate(types) if t in rejected]
+
+    # Vec2 は [x, y] または { x = .., y = .. } の数値2つ
+    # 全要素の長さと型を集合で調べ、問題があるときだけ位置を探す
+    @staticmethod
+    def find_invalid_vec2(column:list, skip:set) -> list:
+        indices = [index for index in range(len(column)) if not index in skip]
+        pairs = [MDValidator.vec2_pair(column[index]) for index in indices]
+        if set(map(len, pairs)).issubset((2,)) and set(map(type, chain.from_iterable(pairs))).issubset((float, int)):
+            return list()
+        invalid = list()
+        for index, pair in zip(indices, pairs):
+            if len(pair) != 2 or not all(type(value) in (float, int) for value in pair):
+                invalid.append((index, '%r is not Vec2' % (column[index],)))
+        return invalid
+
+    @staticmethod
+    def vec2_pair(value) -> list:
+        if isinstance(value, dict):
+            return [value['x'], value['y']] if set(value) == {'x', 'y'} else list()
+        return value
+
+    @staticmethod
+    def make_report(results:list) -> dict:
+        return {
+            'files': results,
+            'file_count': len(results),
+            'record_count': sum(result['records'] for result in results),
+            'error_count': sum(len(result['errors']) for result in results)}
+
+    @staticmethod
+    def summary(report:dict) -> str:
+        lines = list()
+        for result in report['files']:
+            status = 'OK' if len(result['errors']) == 0 else 'NG'
+            lines.append('[%s] %s (%d records, %d errors)' % (status, result['path'], result['records'], len(result['errors'])))
+            for error in result['errors']:
+                lines.append('    %s' % error['message'])
+                for field in error['fields']:
+                    lines.append('    > %s' % field)
+        lines.append('%d files, %d records, %d errors' % (report['file_count'], report['record_count'], report['error_count']))
+        if report.get('aborted', False):
+            lines.append('aborted: the number of errors reached --max-errors')
+        return '\n'.join(lines)
+
+
+# 全ファイルの主キーIDとID型fieldの参照を集め、重複と参照切れを探す
+# IDの種類ごとに定義域 (id.toml の begin-end) の大きさの表で主キーの出現回数を数えるので、
+# 重複は回数が2以上、参照切れは回数が0を引くだけで済み、全体のレコード数に比例した時間で終わる
+class MDReferenceIndex:
+    def __init__(self, id_mgr:IdManager):
+        self.id_mgr = id_mgr
+        self.primary_keys = dict() # ID名 -> [(結果の位置, key の列, 値の列), ...]
+        self.references = dict()   # ID名 -> [(結果の位置, field名, key の列, 値の列), ...]
+
+    # ids: MDValidator.collect_ids の返り値 (型情報がない・読み込めなかったファイルは None)
+    def add(self, result_index:int, ids:dict):
+        if ids == None:
+            return
+        if ids['primary'] != None:
+            id_name, keys, values = ids['primary']
+            self.primary_keys.setdefault(id_name, list()).append((result_index, keys, values))
+        for field_name, id_name, keys, values in ids['references']:
+            self.references.setdefault(id_name, list()).append((result_index, field_name, keys, values))
+
+    # (結果の位置, key, ID名, 値, メッセージ, 詳細) を返す
+    # changed_keys (結果の位置 -> key の集合) と affected (ID名 -> 主キーIDの集合) を渡すと、
+    # 重複は affected の値だけ、参照切れは changed_keys のレコードか affected の値を参照しているものだけを確認する
+    def find_errors(self, results:list, changed_keys:dict=None, affected:dict=None) -> list:
+        errors = list()
+        for id_name in sorted(self.primary_keys.keys() | self.references.keys()):
+            id_info = self.id_mgr.search_id_by_name(id_name)
+            counts = self.count_primary_keys(id_name, id_info)
+            targets = None if affected == None else affected.get(id_name, set())
+            errors.extend(self.find_duplicates(id_name, id_info, counts, results, targets))
+            errors.extend(self.find_dangling_references(id_name, id_info, counts, changed_keys, targets))
+        Profiler.count('references_resolved', sum(len(values) for entries in self.references.values() for _, _, _, values in entries))
+        return errors
+
+    # 定義域の先頭からの位置ごとの主キーの出現回数
+    # numpy があれば (出現した位置の昇順の配列, その回数の配列)、無ければ Counter
+    # 定義域の広さではなくレコード数に比例する大きさにする
+    def count_primary_keys(self, id_name:str, id_info):
+        values = [value for _, _, entry_values in self.primary_keys.get(id_name, ()) for value in entry_values]
+        numpy = import_numpy()
+        if numpy is None:
+            return Counter(value - id_info.begin for value in values)
+        offsets = numpy.array(values, dtype=numpy.int64) - id_info.begin
+        return numpy.unique(offsets, return_counts=True)
+
+    def find_duplicates(self, id_name:str, id_info, counts, results:list, targets:set=None) -> list:
+        duplicated = {offset for offset, count in self.nonzero_items(counts) if count > 1}
+        if targets != None:
+            duplicated = {offset for offset in duplicated if offset + id_info.begin in targets}
+        if len(duplicated) == 0:
+            return list()
+        # 重複している値ごとに定義しているすべてのレコードを集める
+        definitions = dict() # 値 -> [(結果の位置, key), ...]
+        for result_index, keys, values in self.primary_keys[id_name]:
+            for key, value in zip(keys, values):
+                if value - id_info.begin in duplicated:
+                    definitions.setdefault(value, list()).append((result_index, key))
+        errors = list()
+        for value, locations in sorted(definitions.items()):
+            fields = ['%s: [%s]' % (results[result_index]['path'], key) for result_index, key in locations]
+            for result_index, key in locations:
+                errors.append((result_index, key, id_name, value, 'The primary key %sID %d is defined more than once. (key: [%s])' % (id_name, value, key), fields))
+        return errors
+
+    def find_dangling_references(self, id_name:str, id_info, counts, changed_keys:dict=None, targets:set=None) -> list:
+        errors = list()
+        numpy = import_numpy()
+        for result_index, field_name, keys, values in self.references.get(id_name, ()):
+            if numpy is None:
+                missing = [index for index, value in enumerate(values) if counts[value - id_info.begin] == 0]
+            else:
+                defined, _ = counts
+                offsets = numpy.array(values, dtype=numpy.int64) - id_info.begin
+                missing = numpy.flatnonzero(~numpy.isin(offsets, defined)).tolist()
+            if targets != None:
+                changed = changed_keys.get(result_index, set())
+                missing = [index for index in missing if keys[index] in changed or values[index] in targets]
+            for index in missing:
+                errors.append((result_index, keys[index], id_name, values[index],
+                    'The submitted data refers to undefined %sID. (key: [%s])' % (id_name, keys[index]),
+                    ['%s: %d is not defined by any record' % (field_name, values[index])]))
+        return errors
+
+    @staticmethod
+    def nonzero_items(counts):
+        if isinstance(counts, Counter):
+            return counts.items()
+        offsets, occurrences = counts
+        return zip(offsets.tolist(), occurrences.tolist())
+
+
+# ProcessPoolExecutor の各ワーカーで使う validator
+# 型情報の読み込みをワーカーごとにやり直さないよう、親プロセスのものを初期化時に受け取る
+worker_validator = None
+
+def init_worker(validator:MDValidator):
+    global worker_validator
+    worker_validator = validator
+
+def validate_toml_task(task:tuple) -> dict:
+    return worker_validator.validate_toml(*task)
+
+def validate_toml_incremental_task(task:tuple) -> tuple:
+    return worker_validator.validate_toml_incremental(*task)
+
 
 if __name__ == "__main__":
     basicConfig(level=INFO)
-    validator = MDValidator()
-    validator.validate()
+    parser = argparse.ArgumentParser(description='実データが masterdata.toml の型定義に適合しているかを確認する')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='検証の並列数 (0ならCPUコア数)')
+    parser.add_argument('--report', type=Path,
+        help='検証結果をJSONで書き出すパス')
+    parser.add_argument('--no-cache', action='store_true',
+        help='パース済みtomlのキャッシュを使わない')
+    parser.add_argument('--stream', action='store_true',
+        help='ファイル全体を読み込まず、レコードごとにパースして検証する (巨大なファイル向け)')
+    parser.add_argument('--max-errors', type=int,
+        help='エラーがこの数に達したら検証を打ち切る')
+    parser.add_argument('--incremental', action='store_true',
+        help='前回から追加・変更されたレコードだけを検証する (変わっていないレコードは前回の結果を使う)')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    if args.no_cache:
+        TomlCache.set_enabled(False)
+    if args.profile:
+        Profiler.enable()
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
 
+    validator = MDValidator(streaming=args.stream, max_errors=args.max_errors)
+    if args.incremental:
+        store = RecordStore.load(validator.id_mgr)
+        report = validator.validate_incremental(store, jobs)
+        store.save()
+    else:
+        report = validator.validate(jobs)
+    if args.report != None:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    print(MDValidator.summary(report))
+    Profiler.report(args.profile_output)
+    sys.exit(0 if report['error_count'] == 0 else 1)
@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+#coding:utf-8
+
+from pathlib import Path
+import time
+import argparse
+from repository_path import KanjiPath
+from id_manage import IdManager
+from validate_data import MDValidator
+import build_schema
+import md_binary
+from logging import getLogger, basicConfig, DEBUG, INFO
+logger = getLogger(__name__)
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+# masterdata.toml / id.toml / class/**/*.toml の変更を待つ
+# inotify_simple があれば inotify で起こされ、無ければ interval ごとにポーリングする
+# どちらの場合も、何が変わったかはファイルの (mtime, size) の差分で求める
+class FileWatcher:
+    def __init__(self, files:list, directory:Path, interval:float, debounce:float, use_inotify:bool=True):
+        self.files = [Path(file).absolute() for file in files]
+        self.directory = directory.absolute()
+        self.interval = interval
+        self.debounce = debounce
+        self.inotify = None
+        self.watched_directories = set()
+        if use_inotify and inotify_simple is not None:
+            flags = inotify_simple.flags
+            self.mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.CREATE | flags.DELETE
+            self.inotify = inotify_simple.INotify()
+            self.watch_directories()
+        logger.info('watching with %s' % ('inotify' if self.inotify is not None else 'polling'))
+        self.snapshot = self.take_snapshot()
+
+    # class 以下に増えたディレクトリも監視対象に加える
+    # 消えたディレクトリの監視はカーネル側で外れるので、作り直されたら追加し直せるよう忘れておく
+    def watch_directories(self):
+        self.watched_directories = {directory for directory in self.watched_directories if directory.is_dir()}
+        directories = {file.parent for file in self.files} | {self.directory}
+        directories |= {path for path in self.directory.glob('**/') if path.is_dir()}
+        for directory in directories - self.watched_directories:
+            self.inotify.add_watch(directory, self.mask)
+        self.watched_directories |= directories
+
+    def take_snapshot(self) -> dict:
+        snapshot = dict()
+        for file in self.files + list(self.directory.glob('**/*.toml')):
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            snapshot[file] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    # 変更があるまで待ち、変更 (追加・削除を含む) されたファイルの集合を返す
+    # 最後の変更から debounce 秒何も起きなくなるまで待ってからまとめて返す
+    def wait_changes(self) -> set:
+        while True:
+            self.wait_event(None)
+            while self.wait_event(self.debounce):
+                pass
+            snapshot = self.take_snapshot()
+            changed = {file for file in snapshot.keys() | self.snapshot.keys() if snapshot.get(file) != self.snapshot.get(file)}
+            self.snapshot = snapshot
+            if len(changed) != 0:
+                return changed
+
+    # timeout 秒以内に何か起きたか (None なら起きるまで待つ)
+    def wait_event(self, timeout:float) -> bool:
+        if self.inotify is not None:
+            events = self.inotify.read(timeout=None if timeout is None else int(timeout * 1000))
+            self.watch_directories()
+            return len(events) != 0
+        if timeout is None:
+            while self.take_snapshot() == self.snapshot:
+                time.sleep(self.interval)
+            return True
+        snapshot = self.take_snapshot()
+        time.sleep(timeout)
+        return self.take_snapshot() != snapshot
+
+
+# 型情報・ID情報・検証結果をメモリに持ち続け、変更されたものだけを検証・生成し直す
+class WatchSession:
+    def __init__(self, repository:str, layout:str, compact:bool=False):
+        self.validator = MDValidator()
+        self.type_mgr = self.validator.type_mgr
+        self.id_mgr = self.validator.id_mgr
+        self.repository = repository
+        self.layout = layout
+        self.compact = compact
+        self.dest_dir = KanjiPath.absolute('md_header')
+        self.md_toml = KanjiPath.absolute('md_toml').absolute()
+        self.id_toml = Path(IdManager.ID_TOML).absolute()
+        self.results = dict() # class/ からの相対パス -> validate_toml の結果
+        self.type_hashes = self.collect_type_hashes()
+
+    def collect_type_hashes(self) -> dict:
+        return {
+            build_schema.manifest_key(type_info, key): type_info.content_hash()
+            for key in self.type_mgr.dict_info for type_info in self.type_mgr.dict_info[key].values()}
+
+    def run_all(self):
+        self.run(set(), schema_changed=True, ids_changed=True)
+
+    def handle(self, changed:set):
+        self.run(
+            {file for file in changed if file.suffix == '.toml' and self.validator.root_path.absolute() in file.parents},
+            schema_changed=self.md_toml in changed,
+            ids_changed=self.id_toml in changed)
+
+    def run(self, class_files:set, schema_changed:bool, ids_changed:bool):
+        begin = time.perf_counter()
+        root_path = self.validator.root_path.absolute()
+        if ids_changed:
+            self.id_mgr.reload()
+        if schema_changed:
+            self.type_mgr.reload()
+            type_hashes = self.collect_type_hashes()
+            changed_types = {name for name in type_hashes.keys() | self.type_hashes.keys() if type_hashes.get(name) != self.type_hashes.get(name)}
+        else:
+            type_hashes = self.type_hashes
+            changed_types = set()
+        if schema_changed or (ids_changed and self.layout == 'dense'):
+            options = build_schema.make_options(self.repository, self.layout, self.id_mgr, self.compact)
+            build_schema.create_cpp_sources_incremental(self.type_mgr, self.dest_dir, options=options)
+        # 型定義やIDの定義域が変わったら関係するファイルも検証し直す
+        if ids_changed:
+            class_files = set(root_path.glob('**/*.toml'))
+        else:
+            for toml_path in root_path.glob('**/*.toml'):
+                sub_directories, type_name = self.validator.toml_task(toml_path)
+                name = type_name if sub_directories == ('.',) else '%s/%s' % ('/'.join(sub_directories), type_name)
+                if name in changed_types:
+                    class_files.add(toml_path)
+        for toml_path in sorted(class_files):
+            self.validate_file(toml_path)
+        # 途中で失敗したときは、やり直しで同じ型を変更ありとして扱えるよう最後に更新する
+        self.type_hashes = type_hashes
+        elapsed = (time.perf_counter() - begin) * 1000
+        error_count = sum(len(result['errors']) for result in self.results.values())
+        logger.info('%d files checked in %.1f ms (%d errors in %d files)' % (len(class_files), elapsed, error_count, len(self.results)))
+
+    def validate_file(self, toml_path:Path):
+        relative_path = toml_path.relative_to(self.validator.root_path.absolute())
+        if not toml_path.is_file():
+            self.results.pop(str(relative_path), None)
+            logger.info('removed: %s' % relative_path)
+            return
+        result = self.validator.validate_toml(*self.validator.toml_task(toml_path))
+        self.results[result['path']] = result
+        if self.repository == 'binary' and len(result['errors']) == 0:
+            md_binary.export_file(self.validator, result)
+
+
+if __name__ == "__main__":
+    basicConfig(level=INFO)
+    parser = argparse.ArgumentParser(description='マスターデータの変更を監視し、変わったものだけを検証・生成し直す')
+    build_schema.add_option_arguments(parser)
+    parser.add_argument('--interval', type=float, default=0.2,
+        help='ポーリング間隔 (秒)')
+    parser.add_argument('--debounce', type=float, default=0.05,
+        help='最後の変更からこの秒数待ってから処理する')
+    parser.add_argument('--poll', action='store_true',
+        help='inotify を使わずポーリングで監視する')
+    args = parser.parse_args()
+
+    session = WatchSession(args.repository, args.layout, args.compact)
+    session.run_all()
+    watcher = FileWatcher(
+        [session.md_toml, session.id_toml], session.validator.root_path,
+        args.interval, args.debounce, use_inotify=not args.poll)
+    # 処理に失敗しても止まらず、それまでの型情報・ID情報のまま監視を続ける
+    # 失敗した変更は覚えておき、次の変更と合わせてやり直す
+    pending = set()
+    try:
+        while True:
+            changed = pending | watcher.wait_changes()
+            try:
+                session.handle(changed)
+                pending = set()
+            except Exception:
+                logger.exception('failed to process changes, keeping the last loaded schema and IDs')
+                pending = changed
+    except KeyboardInterrupt:
+        pass